@@ -1,6 +1,8 @@
 from datetime import datetime, timedelta
 from airflow import DAG
-from airflow.operators.bash import BashOperator   
+from airflow.operators.bash import BashOperator
+from airflow.sdk import task
+from config import use_worker, worker_host, worker_port
 
 default_args = {
     'owner': 'airflow',
@@ -14,11 +16,63 @@ dag = DAG(
     'first_dag',
     default_args=default_args,
     schedule=timedelta(hours=1),
-    catchup=False 
+    catchup=False,
+    max_active_runs=1,
 )
 
-run_script = BashOperator(
-    task_id='run_script',
-    bash_command='python3 /opt/airflow/python_scripts/main.py',
+# Pools created by airflow-init (docker-compose.yaml), they cap the tasks hitting each API at the same time
+LINKEDIN_POOL = 'linkedin'
+GEMINI_POOL = 'gemini'
+
+# The pipeline code lives in python_scripts (in the PYTHONPATH of the image), imported inside
+# the tasks so parsing the DAG doesn't load it
+
+
+@task(pool=LINKEDIN_POOL)
+def discover(**context):
+    from stage_functions import discover
+    return discover(context['run_id'])
+
+
+@task(pool=LINKEDIN_POOL, retries=3, retry_exponential_backoff=True)
+def enrich(shard_path):
+    from stage_functions import enrich_shard
+    return enrich_shard(shard_path)
+
+
+@task(pool=GEMINI_POOL, retries=3, retry_exponential_backoff=True)
+def classify(shard_path):
+    from stage_functions import classify_shard
+    return classify_shard(shard_path)
+
+
+# Runs once every upstream task is done, also when discover found no new jobs (the mapped tasks are skipped)
+# or a shard failed after its retries: the other shards are still loaded, the jobs of a failed enrich shard
+# come back in the next discover and the ones of a failed classify shard are classified in the backlog
+@task(trigger_rule='all_done')
+def load(enriched_paths, classified_paths, **context):
+    from stage_functions import load_shards
+    return load_shards(list(enriched_paths), list(classified_paths), context['run_id'])
+
+
+compact_dataset = BashOperator(
+    task_id='compact_dataset',
+    bash_command='python3 /opt/airflow/python_scripts/dataset_functions.py',
     dag=dag,
 )
+
+if use_worker:
+    # The long-running worker (python_scripts/worker.py) does the run, its answer (run metrics) goes to XCom
+    run_worker = BashOperator(
+        task_id='run_worker',
+        bash_command=f'curl -fsS --max-time 3300 -X POST http://{worker_host}:{worker_port}/run',
+        dag=dag,
+    )
+    run_worker >> compact_dataset
+else:
+    with dag:
+        # One mapped enrich and classify task per shard of job cards, only Parquet paths go through XCom
+        jobcard_shards = discover()
+        enriched_shards = enrich.expand(shard_path=jobcard_shards)
+        classified_shards = classify.expand(shard_path=enriched_shards)
+        load(enriched_shards, classified_shards) >> compact_dataset
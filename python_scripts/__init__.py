@@ -1,3 +1,16 @@
 from .db_functions import *
 from .config import *
-from .genai_functions import *
\ No newline at end of file
+from .genai_functions import *
+from .fetch_functions import *
+from .cache_functions import *
+from .parsing_functions import *
+from .archive_functions import *
+from .checkpoint_functions import *
+from .dataset_functions import *
+from .rules_functions import *
+from .dedup_functions import *
+from .metrics_functions import *
+from .stage_functions import *
+from .summary_functions import *
+from .schema_functions import *
+from .search_functions import *
@@ -0,0 +1,128 @@
+import glob
+import json
+import logging
+import os
+import threading
+import zlib
+from datetime import datetime
+
+from config import archive_dir
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveMissError(LookupError):
+    """Raised in replay mode when a URL was never archived."""
+
+
+class ArchivedResponse:
+    """Minimal stand-in for requests.Response with the fields the pipeline reads."""
+
+    def __init__(self, url: str, status_code: int, content: bytes):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+
+
+class HtmlArchive:
+    """
+    On-disk archive of the fetched HTML.
+
+    Each run appends zlib-compressed pages to its own segment file (run_<timestamp>.seg)
+    and writes one JSON line per page to the matching index file (run_<timestamp>.idx.jsonl)
+    with the URL, fetch time and the position of the page in the segment.
+
+    Args:
+        directory (str): Directory that holds the segments and indexes.
+    """
+
+    def __init__(self, directory: str = archive_dir):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.segment_file = None
+        self.index_file = None
+        self.index = None
+
+    def _open_run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        run_name = f"run_{datetime.now().strftime('%Y%m%dT%H%M%S')}"
+        self.segment_name = f"{run_name}.seg"
+        self.segment_file = open(os.path.join(self.directory, self.segment_name), 'ab')
+        self.index_file = open(os.path.join(self.directory, f"{run_name}.idx.jsonl"), 'a')
+
+    def write(self, url: str, status_code: int, content: bytes):
+        """Appends a fetched page to this run's segment."""
+        compressed = zlib.compress(content)
+        with self.lock:
+            if self.segment_file is None:
+                self._open_run()
+            offset = self.segment_file.tell()
+            self.segment_file.write(compressed)
+            self.segment_file.flush()
+            entry = {
+                'url': url,
+                'fetched_at': datetime.now().isoformat(),
+                'status_code': status_code,
+                'segment': self.segment_name,
+                'offset': offset,
+                'length': len(compressed),
+            }
+            self.index_file.write(json.dumps(entry) + '\n')
+            self.index_file.flush()
+
+    def load_index(self) -> dict:
+        """Reads every index file, keeping the latest fetch of each URL."""
+        index = {}
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.idx.jsonl'))):
+            with open(path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if entry['url'] not in index or entry['fetched_at'] > index[entry['url']]['fetched_at']:
+                        index[entry['url']] = entry
+        logger.info(f"Loaded archive index with {len(index)} URLs from {self.directory}")
+        return index
+
+    def read(self, url: str) -> ArchivedResponse:
+        """Returns the latest archived page for the URL."""
+        with self.lock:
+            if self.index is None:
+                self.index = self.load_index()
+        entry = self.index.get(url)
+        if entry is None:
+            raise ArchiveMissError(f"{url} is not in the archive")
+
+        with open(os.path.join(self.directory, entry['segment']), 'rb') as f:
+            f.seek(entry['offset'])
+            content = zlib.decompress(f.read(entry['length']))
+        return ArchivedResponse(url, entry['status_code'], content)
+
+    def roll(self):
+        """Closes the current segment, so the next write starts the segment of a new run."""
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.segment_file is not None:
+                self.segment_file.close()
+                self.index_file.close()
+                self.segment_file = None
+                self.index_file = None
+
+
+class ReplayFetcher:
+    """Serves pages from an HtmlArchive with the same interface as fetch_functions.Fetcher."""
+
+    def __init__(self, archive: HtmlArchive):
+        self.archive = archive
+
+    def get(self, url: str) -> ArchivedResponse:
+        return self.archive.read(url)
+
+    def map(self, func, urls: list[str]) -> list:
+        results = []
+        for url in urls:
+            try:
+                results.append(func(url, self.get(url)))
+            except Exception as e:
+                results.append(e)
+        return results
@@ -0,0 +1,89 @@
+"""
+Correctness check and micro-benchmark of the HTML parsing backends.
+
+Runs parse_jobcards and get_job_info with every backend in PARSER_BACKENDS over saved
+pages and compares the results with the 'html.parser' reference.
+
+Usage:
+    python benchmark_parsers.py [fixtures_dir] [--repeat N]
+
+The fixtures directory holds search result pages named jobcards_*.html and job detail
+pages named job_*.html. By default the sanitized pages committed in fixtures/ are used.
+The exit code is 1 if any backend differs from the reference.
+"""
+import argparse
+import glob
+import os
+import time
+
+from main import parse_jobcards, get_job_info
+from parsing_functions import PARSER_BACKENDS, make_soup
+
+REFERENCE_BACKEND = 'html.parser'
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def extract(content: bytes, page_type: str, backend: str):
+    soup = make_soup(content, page_type, backend)
+    if page_type == 'jobcards':
+        return list(parse_jobcards(soup))
+    return get_job_info(soup)
+
+
+def load_fixtures(fixtures_dir: str) -> list[tuple[str, str, bytes]]:
+    fixtures = []
+    for page_type in ('jobcards', 'job'):
+        for path in sorted(glob.glob(os.path.join(fixtures_dir, f'{page_type}_*.html'))):
+            with open(path, 'rb') as f:
+                fixtures.append((os.path.basename(path), page_type, f.read()))
+    return fixtures
+
+
+def check_backends(fixtures) -> bool:
+    """Returns True if every backend produces the same dicts as the reference backend."""
+    all_equal = True
+    for name, page_type, content in fixtures:
+        expected = extract(content, page_type, REFERENCE_BACKEND)
+        for backend in PARSER_BACKENDS:
+            if extract(content, page_type, backend) != expected:
+                print(f'MISMATCH: {backend} differs from {REFERENCE_BACKEND} on {name}')
+                all_equal = False
+    return all_equal
+
+
+def benchmark_backends(fixtures, repeat: int) -> dict:
+    """Returns the mean milliseconds per page for each backend."""
+    timings = {}
+    for backend in PARSER_BACKENDS:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for _, page_type, content in fixtures:
+                extract(content, page_type, backend)
+        timings[backend] = (time.perf_counter() - start) * 1000 / (repeat * len(fixtures))
+    return timings
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fixtures_dir', nargs='?', default=FIXTURES_DIR,
+                        help='Directory with jobcards_*.html and job_*.html pages')
+    parser.add_argument('--repeat', type=int, default=20, help='Times each page is parsed per backend')
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures_dir)
+    if not fixtures:
+        raise SystemExit(f'No fixtures found in {args.fixtures_dir}')
+    print(f'Loaded {len(fixtures)} pages')
+
+    backends_equal = check_backends(fixtures)
+    if backends_equal:
+        print('All backends produce the same job cards and job info')
+
+    timings = benchmark_backends(fixtures, args.repeat)
+    reference = timings[REFERENCE_BACKEND]
+    for backend, ms in sorted(timings.items(), key=lambda item: item[1]):
+        print(f'{backend:<22} {ms:8.2f} ms/page  {reference / ms:5.1f}x')
+
+    if not backends_equal:
+        raise SystemExit(1)
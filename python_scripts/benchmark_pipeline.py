@@ -0,0 +1,443 @@
+"""
+Offline throughput benchmark of the pipeline stages.
+
+Starts a local HTTP server that serves search result and job pages, with a configurable
+latency and share of 429 responses, and replaces the Gemini model with a stub that has
+its own latency and share of malformed JSON answers. Then, for each size, it runs in a
+fresh process:
+
+    discover  get_jobcards_soup + get_list_of_jobcards over the search pages
+    enrich    enrich_job_list over the discovered job cards
+    classify  classify_job_descriptions (the batched classification loop)
+    load      insert_into_db of the base and GenAI rows, pipeline_batch_size rows per call
+
+and reports jobs/sec, p50/p99 latency per stage (per page, per job page request, per
+Gemini call and per insert) and the peak RSS of the process.
+
+Usage:
+    python benchmark_pipeline.py [--sizes 100 1000 10000] [--fixtures-dir DIR]
+                                 [--output results.json] [--baseline results.json]
+
+With --fixtures-dir, the recorded pages in the same layout as benchmark_parsers.py
+(jobcards_*.html and job_*.html) are served instead of the synthetic ones. The job ids
+of the recorded search pages are rewritten so every page has new postings.
+With --baseline, the exit code is 1 if the jobs/sec of any stage dropped by more than
+--tolerance compared with a previous --output file.
+
+Before the runs it checks that a batch where no job has skills, classified by the model and
+then read from the classification cache, is stored with an empty skills mask. The exit code
+is 1 if it isn't, --check-only stops after the check.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+STAGES = ['discover', 'enrich', 'classify', 'load']
+
+WORDS = ("data pipelines etl airflow spark python sql aws azure gcp bigquery snowflake databricks "
+         "modelado datos calidad governance experiencia años years team cloud api git ci/cd "
+         "monitoring migration dashboards analysts kafka dbt docker kubernetes english inglés").split()
+
+JOBCARD_TEMPLATE = """<li><div class="base-card" data-entity-urn="urn:li:jobPosting:{job_id}">
+<div class="base-search-card__info">
+<h3 class="base-search-card__title">Data Engineer {job_id}</h3>
+<h4 class="base-search-card__subtitle"><a class="hidden-nested-link">Company {company}</a></h4>
+<div class="base-search-card__metadata">
+<span class="job-search-card__location">Santiago, Chile</span>
+<time class="job-search-card__listdate" datetime="{date}">1 day ago</time>
+</div></div></div></li>"""
+
+JOB_TEMPLATE = """<html><body><section class="description">
+<div class="description__text description__text--rich">
+<div class="show-more-less-html__markup"><p>{paragraph}</p><ul>{bullets}</ul></div>
+<button><span>Show more</span></button></div>
+<ul class="description__job-criteria-list">
+<li class="description__job-criteria-item"><h3 class="description__job-criteria-subheader">Seniority level</h3>
+<span class="description__job-criteria-text description__job-criteria-text--criteria">Mid-Senior level</span></li>
+<li class="description__job-criteria-item"><h3 class="description__job-criteria-subheader">Employment type</h3>
+<span class="description__job-criteria-text description__job-criteria-text--criteria">Full-time</span></li>
+<li class="description__job-criteria-item"><h3 class="description__job-criteria-subheader">Job function</h3>
+<span class="description__job-criteria-text description__job-criteria-text--criteria">Information Technology</span></li>
+<li class="description__job-criteria-item"><h3 class="description__job-criteria-subheader">Industries</h3>
+<span class="description__job-criteria-text description__job-criteria-text--criteria">IT Services</span></li>
+</ul></section></body></html>"""
+
+CARDS_PER_PAGE = 25
+
+
+def synthetic_jobcards_page(start: int) -> bytes:
+    cards = "\n".join(JOBCARD_TEMPLATE.format(job_id=start + i, company=(start + i) % 97, date=date.today().isoformat())
+                      for i in range(CARDS_PER_PAGE))
+    return f"<html><body><ul>{cards}</ul></body></html>".encode()
+
+
+def synthetic_job_page(job_id: int) -> bytes:
+    rng = random.Random(job_id)
+    paragraph = " ".join(rng.choice(WORDS) for _ in range(250))
+    bullets = "".join(f"<li>{' '.join(rng.choice(WORDS) for _ in range(12))}</li>" for _ in range(8))
+    return JOB_TEMPLATE.format(paragraph=paragraph, bullets=bullets).encode()
+
+
+class PageServer(ThreadingHTTPServer):
+    """
+    Local stand-in for LinkedIn. Search pages have CARDS_PER_PAGE job cards with ids from
+    the 'start' parameter on, job pages are /jobs/view/<id>/.
+
+    Args:
+        latency (float): Seconds slept before every response.
+        rate_limit_share (float): Share of the requests answered with a 429.
+        jobcards_pages (list[bytes]): Recorded search pages, synthetic ones if empty.
+        job_pages (list[bytes]): Recorded job pages served round robin, synthetic ones if empty.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency: float, rate_limit_share: float, jobcards_pages=(), job_pages=()):
+        super().__init__(('127.0.0.1', 0), PageHandler)
+        self.latency = latency
+        self.rate_limit_share = rate_limit_share
+        self.jobcards_pages = list(jobcards_pages)
+        self.job_pages = list(job_pages)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def jobcards_page(self, start: int) -> bytes:
+        if not self.jobcards_pages:
+            return synthetic_jobcards_page(start)
+        # Renumber the recorded postings so each page only has new job ids
+        page = self.jobcards_pages[(start // CARDS_PER_PAGE) % len(self.jobcards_pages)]
+        ids = iter(range(start, start + 10 ** 6))
+        return re.sub(rb'urn:li:jobPosting:\d+', lambda m: b'urn:li:jobPosting:%d' % next(ids), page)
+
+    def job_page(self, job_id: int) -> bytes:
+        if not self.job_pages:
+            return synthetic_job_page(job_id)
+        return self.job_pages[job_id % len(self.job_pages)]
+
+
+class PageHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if random.random() < self.server.rate_limit_share:
+            self.send_response(429)
+            self.end_headers()
+            return
+
+        url = urlparse(self.path)
+        if url.path.startswith('/jobs/view/'):
+            body = self.server.job_page(int(url.path.strip('/').split('/')[-1]))
+        elif 'search' in url.path:
+            body = self.server.jobcards_page(int(parse_qs(url.query).get('start', ['0'])[0]))
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeUsage:
+    def __init__(self, prompt_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+
+class FakeResponse:
+    def __init__(self, text: str, prompt: str):
+        self.text = text
+        self.usage_metadata = FakeUsage(len(prompt) // 4, len(text) // 4)
+
+
+class FakeGenerativeModel:
+    """
+    Stub of genai.GenerativeModel. Answers with the example classification of the prompt,
+    restricted to the keys it asks for and with one object per id for batch prompts.
+
+    Args:
+        latency (float): Seconds slept in every call.
+        malformed_share (float): Share of the answers that are not valid JSON.
+        no_skills (bool): Answer with an empty skills_mentioned list.
+    """
+
+    def __init__(self, latency: float, malformed_share: float, no_skills: bool = False):
+        self.latency = latency
+        self.malformed_share = malformed_share
+        self.no_skills = no_skills
+
+    def generate_content(self, prompt: str) -> FakeResponse:
+        time.sleep(self.latency)
+        if random.random() < self.malformed_share:
+            return FakeResponse('{"task_clarity": "Clear", "skills_mentioned": [', prompt)
+
+        example_block = prompt.split('Required JSON Output Format')[1].split('Provide ONLY')[0]
+        example = json.loads(example_block[example_block.index(':') + 1:])
+        if self.no_skills:
+            example = [dict(item, skills_mentioned=[]) for item in example]
+        ids = re.findall(r'Job Description \(id: ([^)]+)\)', prompt)
+        if ids:
+            template = {k: v for k, v in example[0].items() if k != 'id'}
+            answer = [dict(template, id=item_id) for item_id in ids]
+        else:
+            answer = example
+        return FakeResponse(json.dumps(answer), prompt)
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def stage_result(jobs: int, seconds: float, latencies: list[float]) -> dict:
+    return {
+        'jobs': jobs,
+        'seconds': round(seconds, 3),
+        'jobs_per_sec': round(jobs / seconds, 2) if seconds else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def run_size(size: int, args) -> dict:
+    """Runs the four stages over size postings against the server at args.base_url."""
+    import polars as pl
+
+    import genai_functions
+    from config import job_names, locations, keywords, classification_batch_size, pipeline_batch_size
+    from db_functions import insert_into_db
+    from fetch_functions import Fetcher, set_fetcher
+    from genai_functions import LLMExecutor, classify_job_descriptions
+    from main import get_jobcards_soup, get_list_of_jobcards, enrich_job_list
+    from metrics_functions import metrics
+
+    class LocalFetcher(Fetcher):
+        """Fetcher that sends every request to the local server and records its latency."""
+
+        def __init__(self, base_url: str, **kwargs):
+            super().__init__(**kwargs)
+            self.base_url = base_url
+            self.latencies: list[float] = []
+
+        def get(self, url: str):
+            url = urlparse(url)
+            start = time.perf_counter()
+            r = super().get(f"{self.base_url}{url.path}?{url.query}")
+            self.latencies.append(time.perf_counter() - start)
+            return r
+
+    fetcher = LocalFetcher(args.base_url, max_workers=args.fetch_workers, requests_per_second=args.requests_per_second,
+                           burst=args.fetch_workers, backoff_seconds=args.backoff_seconds)
+    set_fetcher(fetcher)
+    genai_functions.model = FakeGenerativeModel(args.llm_latency, args.malformed_share)
+    metrics.reset()
+    results = {'size': size}
+
+    # discover
+    joblist, start, page_latencies = [], 0, []
+    stage_start = time.perf_counter()
+    while len(joblist) < size:
+        page_start = time.perf_counter()
+        cards = get_list_of_jobcards(get_jobcards_soup(job_names[0], locations[0], start))
+        page_latencies.append(time.perf_counter() - page_start)
+        if not cards:
+            raise RuntimeError(f'Search page at start={start} has no job cards')
+        joblist.extend(cards)
+        start += len(cards)
+    joblist = joblist[:size]
+    results['discover'] = stage_result(size, time.perf_counter() - stage_start, page_latencies)
+
+    # enrich
+    fetcher.latencies = []
+    stage_start = time.perf_counter()
+    joblist = enrich_job_list(joblist, keywords)
+    results['enrich'] = stage_result(size, time.perf_counter() - stage_start, fetcher.latencies)
+
+    # classify
+    df = (pl.DataFrame(joblist)
+          .filter(pl.col('job_description') != '')
+          .with_columns(pl.col('date').replace('', None)))
+    executor = LLMExecutor(max_workers=args.llm_workers, requests_per_minute=10 ** 6,
+                           tokens_per_minute=10 ** 9, backoff_seconds=args.backoff_seconds)
+    stage_start = time.perf_counter()
+    classifications = classify_job_descriptions(df['job_description'].to_list(),
+                                                batch_size=classification_batch_size,
+                                                executor=executor)
+    results['classify'] = stage_result(len(df), time.perf_counter() - stage_start, executor.latencies)
+    results['classified'] = sum(c is not None for c in classifications)
+
+    # load
+    df_genai = pl.DataFrame([dict(c, job_url=job_url)
+                             for job_url, c in zip(df['job_url'].to_list(), classifications) if c is not None])
+    insert_latencies = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, 'benchmark.duckdb')
+        stage_start = time.perf_counter()
+        for table_name, dataset, df_table in (('base_table', 'base_data', df), ('genai_table', 'genai_data', df_genai)):
+            for df_batch in df_table.iter_slices(pipeline_batch_size):
+                insert_start = time.perf_counter()
+                insert_into_db(df_batch, table_name, db_file, dataset)
+                insert_latencies.append(time.perf_counter() - insert_start)
+        results['load'] = stage_result(len(df), time.perf_counter() - stage_start, insert_latencies)
+
+    # ru_maxrss is in kilobytes on Linux
+    results['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    results['metrics'] = metrics.summary()
+    return results
+
+
+def check_empty_skills_batch() -> bool:
+    """
+    Classifies and upserts a batch where no job has skills, once from the model and once from
+    the classification cache. Polars infers List(Null) for these frames, which used to make
+    the upsert fail.
+
+    Returns:
+        bool: True if both batches were stored with an empty skills mask.
+    """
+    import polars as pl
+
+    import genai_functions
+    from cache_functions import ClassificationCache
+    from config import model_version
+    from db_functions import JobStore
+    from genai_functions import classification_version
+    from main import classify_and_store
+
+    genai_functions.model = FakeGenerativeModel(0.0, 0.0, no_skills=True)
+    descriptions = [f'Data engineer {number}, SQL reporting for the finance team' for number in range(3)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, 'check.duckdb')
+        store = JobStore(db_file)
+        try:
+            cache = ClassificationCache(db_file, classification_version(), model_version, conn=store.conn)
+            for prefix in ('model', 'cache'):
+                df = pl.DataFrame({'job_url': [f'https://example.com/{prefix}/{number}/' for number in range(len(descriptions))],
+                                   'job_description': descriptions})
+                classify_and_store(df, cache, store)
+            masks = store.conn.execute("SELECT skills_mask FROM genai_table").fetchall()
+        finally:
+            store.close()
+    return sorted(masks) == [(0,)] * 2 * len(descriptions)
+
+
+def load_pages(fixtures_dir: str | None) -> tuple[list[bytes], list[bytes]]:
+    if not fixtures_dir:
+        return [], []
+    from benchmark_parsers import load_fixtures
+    fixtures = load_fixtures(fixtures_dir)
+    return ([content for _, page_type, content in fixtures if page_type == 'jobcards'],
+            [content for _, page_type, content in fixtures if page_type == 'job'])
+
+
+def find_regressions(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """Stages whose jobs/sec is more than tolerance below the baseline run of the same size."""
+    baseline_by_size = {run['size']: run for run in baseline}
+    regressions = []
+    for run in results:
+        previous = baseline_by_size.get(run['size'])
+        if previous is None:
+            continue
+        for stage in STAGES:
+            before, now = previous[stage]['jobs_per_sec'], run[stage]['jobs_per_sec']
+            if before and now < before * (1 - tolerance):
+                regressions.append(f"{run['size']} postings, {stage}: {now} jobs/sec vs {before} in the baseline")
+    return regressions
+
+
+def print_report(results: list[dict]):
+    print(f"{'size':>6} {'stage':<9} {'jobs/sec':>10} {'p50 ms':>9} {'p99 ms':>9} {'seconds':>9}")
+    for run in results:
+        for stage in STAGES:
+            r = run[stage]
+            print(f"{run['size']:>6} {stage:<9} {r['jobs_per_sec']:>10.2f} {r['p50_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['seconds']:>9.2f}")
+        print(f"{run['size']:>6} classified {run['classified']}/{run['classify']['jobs']}, peak RSS {run['peak_rss_mb']} MB")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Offline throughput benchmark of the pipeline stages')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='Number of postings of each run')
+    parser.add_argument('--fixtures-dir', help='Directory with recorded jobcards_*.html and job_*.html pages')
+    parser.add_argument('--http-latency', type=float, default=0.02, help='Seconds the server waits before each response')
+    parser.add_argument('--rate-limit-share', type=float, default=0.02, help='Share of the requests answered with a 429')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='Seconds each Gemini call takes')
+    parser.add_argument('--malformed-share', type=float, default=0.02, help='Share of the Gemini answers that are not valid JSON')
+    parser.add_argument('--fetch-workers', type=int, default=8)
+    parser.add_argument('--requests-per-second', type=float, default=200.0, help='Rate limit of the fetcher')
+    parser.add_argument('--llm-workers', type=int, default=8)
+    parser.add_argument('--backoff-seconds', type=float, default=0.05, help='Base backoff of the fetcher and the LLM executor')
+    parser.add_argument('--output', help='Save the results as JSON, to be used later as --baseline')
+    parser.add_argument('--baseline', help='Results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed jobs/sec drop before reporting a regression')
+    parser.add_argument('--verbose', action='store_true', help='Show the pipeline logs')
+    parser.add_argument('--check-only', action='store_true', help='Only run the empty skills check')
+    # Internal: run a single size in this process against an already running server
+    parser.add_argument('--run-size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--base-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_size:
+        from metrics_functions import setup_logging
+        setup_logging(logging.INFO if args.verbose else logging.CRITICAL)
+        # Last line of stdout, read by the parent process
+        print(json.dumps(run_size(args.run_size, args), default=str))
+        sys.exit(0)
+
+    if not check_empty_skills_batch():
+        print('CHECK FAILED: a batch without skills was not stored with an empty skills mask')
+        sys.exit(1)
+    print('A batch without skills is stored with an empty skills mask', file=sys.stderr)
+    if args.check_only:
+        sys.exit(0)
+
+    jobcards_pages, job_pages = load_pages(args.fixtures_dir)
+    server = PageServer(args.http_latency, args.rate_limit_share, jobcards_pages, job_pages)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Each size runs in its own process so the peak RSS and the module state start clean
+    child_args = ['--llm-latency', str(args.llm_latency), '--malformed-share', str(args.malformed_share),
+                  '--fetch-workers', str(args.fetch_workers), '--requests-per-second', str(args.requests_per_second),
+                  '--llm-workers', str(args.llm_workers), '--backoff-seconds', str(args.backoff_seconds),
+                  '--base-url', server.base_url] + (['--verbose'] if args.verbose else [])
+    results = []
+    for size in args.sizes:
+        print(f'Running {size} postings...', file=sys.stderr)
+        child = subprocess.run([sys.executable, __file__, *child_args, '--run-size', str(size)],
+                               stdout=subprocess.PIPE, text=True, check=True)
+        results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+    server.shutdown()
+
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,155 @@
+import duckdb
+import hashlib
+import json
+import logging
+import re
+
+from config import classification_cache_max_entries, classification_cache_max_age_days
+from genai_functions import validate_classification
+from metrics_functions import metrics
+
+logger = logging.getLogger(__name__)
+
+CACHE_TABLE = "classification_cache"
+
+
+def normalize_description(job_description: str) -> str:
+    """Lowercases and collapses whitespace so trivially different copies of a description share a key."""
+    return re.sub(r'\s+', ' ', job_description).strip().lower()
+
+
+def load_result(result: str) -> dict | None:
+    """
+    Parses a cached classification, None if it's not valid anymore (e.g. written before a
+    value was added to the validation), so it's classified again instead of failing the upsert.
+    """
+    classification = json.loads(result)
+    errors = validate_classification(classification)
+    if errors:
+        logger.warning(f"Ignoring invalid cached classification: {errors}")
+        return None
+    return classification
+
+
+def description_key(job_description: str, prompt_version: str, model_version: str) -> str:
+    """Content hash of the normalized description together with the prompt and model versions."""
+    content = f"{prompt_version}\x00{model_version}\x00{normalize_description(job_description)}"
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class ClassificationCache:
+    """
+    Persistent cache of classify_job_description results stored in DuckDB.
+
+    Entries are keyed on a hash of the normalized description, the prompt version and
+    the model version, so changing either of the versions invalidates the old entries.
+
+    Args:
+        db_file (str): Path to the DuckDB file.
+        prompt_version (str): Version of the classifications, see genai_functions.classification_version.
+        model_version (str): Gemini model used for the classification.
+        max_entries (int): Maximum number of entries kept, least recently used are evicted first.
+        max_age_days (int): Entries created more than this many days ago are evicted.
+        conn (duckdb.DuckDBPyConnection): Optional connection to reuse (e.g. JobStore.conn)
+            instead of opening one on db_file. It is left open by close().
+    """
+
+    def __init__(self,
+                 db_file: str,
+                 prompt_version: str,
+                 model_version: str,
+                 max_entries: int = classification_cache_max_entries,
+                 max_age_days: int = classification_cache_max_age_days,
+                 conn: duckdb.DuckDBPyConnection = None):
+        self.prompt_version = prompt_version
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+
+        self.owns_conn = conn is None
+        self.conn = conn if conn is not None else duckdb.connect(database=db_file, read_only=False)
+        self.conn.execute(f"""CREATE TABLE IF NOT EXISTS {CACHE_TABLE}(
+                              cache_key VARCHAR PRIMARY KEY,
+                              prompt_version VARCHAR,
+                              model_version VARCHAR,
+                              result VARCHAR,
+                              created_at TIMESTAMP,
+                              last_hit_at TIMESTAMP
+                              );
+                              """)
+        self.evict()
+
+    def get(self, job_description: str) -> dict | None:
+        """Returns the cached classification for the description, or None on a miss or an invalid entry."""
+        key = description_key(job_description, self.prompt_version, self.model_version)
+        row = self.conn.execute(f"SELECT result FROM {CACHE_TABLE} WHERE cache_key = ?", [key]).fetchone()
+        classification = load_result(row[0]) if row is not None else None
+        if classification is None:
+            self.misses += 1
+            metrics.incr('cache_misses')
+            return None
+
+        self.hits += 1
+        metrics.incr('cache_hits')
+        self.conn.execute(f"UPDATE {CACHE_TABLE} SET last_hit_at = now() WHERE cache_key = ?", [key])
+        return classification
+
+    def put(self, job_description: str, result: dict):
+        """Stores a validated classification for the description."""
+        key = description_key(job_description, self.prompt_version, self.model_version)
+        self.conn.execute(f"""INSERT INTO {CACHE_TABLE}
+                              VALUES (?, ?, ?, ?, now(), now())
+                              ON CONFLICT (cache_key) DO UPDATE SET
+                                  result = excluded.result,
+                                  created_at = excluded.created_at,
+                                  last_hit_at = excluded.last_hit_at;
+                              """,
+                          [key, self.prompt_version, self.model_version, json.dumps(result)])
+
+    def evict(self):
+        """Deletes entries older than max_age_days, then the least recently used ones beyond max_entries."""
+        self.conn.execute(f"DELETE FROM {CACHE_TABLE} WHERE created_at < now() - to_days(?)",
+                          [self.max_age_days])
+        self.conn.execute(f"""DELETE FROM {CACHE_TABLE} WHERE cache_key IN (
+                                  SELECT cache_key FROM {CACHE_TABLE}
+                                  ORDER BY last_hit_at DESC
+                                  OFFSET ?
+                              );
+                              """,
+                          [self.max_entries])
+
+    def stats(self) -> dict:
+        """Hit/miss counters for this run and the current size of the cache."""
+        size = self.conn.execute(f"SELECT count(*) FROM {CACHE_TABLE}").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': size,
+        }
+
+    def close(self):
+        if self.owns_conn:
+            self.conn.close()
+
+
+def lookup_cached(conn, job_descriptions: list[str], prompt_version: str, model_version: str) -> list:
+    """
+    Looks up many descriptions at once without writing to the DB (last_hit_at is not
+    updated), so it works on a read-only connection while another process owns the writes.
+
+    Returns:
+        list: The cached classification of each description, None for the misses and invalid entries.
+    """
+    keys = [description_key(d, prompt_version, model_version) for d in job_descriptions]
+    try:
+        rows = conn.execute(f"SELECT cache_key, result FROM {CACHE_TABLE} WHERE cache_key IN (SELECT unnest(?))",
+                            [keys]).fetchall()
+    except duckdb.CatalogException:
+        # The cache table is created by the first ClassificationCache
+        return [None] * len(keys)
+    found = {key: load_result(result) for key, result in rows}
+    return [found.get(key) for key in keys]
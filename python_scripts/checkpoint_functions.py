@@ -0,0 +1,41 @@
+import json
+import logging
+import os
+from datetime import datetime
+
+from config import checkpoint_file, checkpoint_max_age_seconds
+
+logger = logging.getLogger(__name__)
+
+
+def load_checkpoint(path: str = checkpoint_file) -> dict | None:
+    """Returns the saved checkpoint, or None if there is none."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(checkpoint: dict, path: str = checkpoint_file):
+    """Writes the checkpoint atomically, so a crash while saving keeps the previous one."""
+    checkpoint = dict(checkpoint, updated_at=datetime.now().isoformat())
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def get_resume_checkpoint(path: str = checkpoint_file,
+                          max_age_seconds: int = checkpoint_max_age_seconds) -> dict | None:
+    """
+    Returns the checkpoint of the previous run if it didn't finish and is recent enough to
+    resume. Older checkpoints are ignored because the search results shift as new jobs are posted.
+    """
+    checkpoint = load_checkpoint(path)
+    if checkpoint is None or checkpoint.get('status') != 'running' or 'discovery_starts' not in checkpoint:
+        return None
+    age = (datetime.now() - datetime.fromisoformat(checkpoint['updated_at'])).total_seconds()
+    if age > max_age_seconds:
+        logger.info(f"Ignoring checkpoint from {checkpoint['updated_at']}, too old to resume")
+        return None
+    return checkpoint
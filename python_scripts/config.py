@@ -3,8 +3,10 @@ model_version = "gemini-2.0-flash-lite"
 
 date_posted_in_seconds = 604800 # 86400 -> 1 day, 2592000 -> 1 month, 604800 -> 1 week
 date_posted_in_days = date_posted_in_seconds / 86400
-job_name = 'data engineer'
-location = 'Chile'
+# Every job name is searched in every location, postings returned by several searches are processed once
+job_names = ['data engineer']
+locations = ['Chile']
+search_queries = [(job_name, location) for job_name in job_names for location in locations]
 
 keywords = ["data engineer",
             "data enginer",
@@ -14,3 +16,84 @@ keywords = ["data engineer",
 
 
 
+# Fetching: concurrency, politeness per host and retries
+fetch_max_workers = 4
+fetch_requests_per_second = 0.5 # Per host
+fetch_burst = 2
+fetch_max_retries = 3
+fetch_backoff_seconds = 2
+fetch_timeout = 10
+
+# Output paths
+output_dir = '/opt/airflow/output'
+db_file = f'{output_dir}/my_project.duckdb'
+
+# Cache of LLM classifications, entries older than this or beyond the max size are evicted
+classification_cache_max_entries = 50000
+classification_cache_max_age_days = 90
+
+# Number of job descriptions sent to Gemini in each prompt
+classification_batch_size = 10
+
+# Gemini client: parallel calls, quota and backoff on 429/5xx
+llm_max_workers = 4
+llm_requests_per_minute = 30
+llm_tokens_per_minute = 1000000
+llm_max_retries = 5
+llm_backoff_seconds = 2
+
+# Discovery: maximum number of search result pages walked per search, and searches run concurrently
+discovery_max_pages = 40
+discovery_max_workers = 4
+# Enrichment: number of job cards fetched concurrently before yielding them downstream
+enrich_chunk_size = 20
+
+# HTML parsing backend, see parsing_functions.PARSER_BACKENDS
+html_parser_backend = 'lxml-strained'
+
+# Raw HTML archive, every page fetched is stored here and can be parsed again with --replay
+archive_enabled = True
+archive_dir = f'{output_dir}/raw_html'
+
+# Pipeline: jobs per micro-batch committed to the DB, and how long an unfinished run can be resumed
+pipeline_batch_size = 25
+checkpoint_file = f'{output_dir}/pipeline_checkpoint.json'
+checkpoint_max_age_seconds = 3 * 3600
+
+# Parquet dataset partitioned by posting date (date=YYYY-MM-DD/), compacted when a partition has this many files
+dataset_dir = f'{output_dir}/jobs_dataset'
+compaction_min_files = 4
+
+# Rule based pre-classifier: fields with at least this confidence are not asked to the LLM
+use_rules = True
+rules_confidence_threshold = 0.8
+
+# Near duplicate detection: MinHash permutations, LSH bands and minimum estimated similarity
+near_duplicate_num_perm = 64
+near_duplicate_bands = 8
+near_duplicate_threshold = 0.85
+near_duplicate_shingle_size = 5
+
+# Run metrics
+# Directory of the per-run metrics JSON files (<run_id>.json and latest.json)
+metrics_dir = f'{output_dir}/run_metrics'
+
+# Airflow DAG: job cards per shard (each one is enriched and classified by its own mapped task) and
+# directory of the Parquet files the tasks pass to each other, one subdirectory per DAG run
+stage_shard_size = 50
+stage_dir = f'{output_dir}/stages'
+# Slots of the Airflow pools (set by airflow-init in docker-compose.yaml, keep them equal). Each mapped task
+# has its own rate limiters, so the enrich and classify tasks get the limits above divided by these.
+linkedin_pool_slots = 2
+gemini_pool_slots = 4
+
+# Long-running worker (worker.py): the DAG triggers the runs through its HTTP API instead of starting main.py.
+# It opens the DuckDB file only while a run is in progress, so the search, summary and rules CLIs work between
+# runs but fail with a lock error during one. Don't enable it together with the staged DAG tasks.
+use_worker = False
+worker_host = 'pipeline-worker'
+worker_port = 8793
+
+# Keyword search over the job descriptions (search_functions.py): BM25 term frequency saturation and length normalization
+search_bm25_k1 = 1.2
+search_bm25_b = 0.75
@@ -0,0 +1,100 @@
+import argparse
+import glob
+import logging
+import os
+import uuid
+from datetime import datetime
+
+import polars as pl
+
+from config import dataset_dir, compaction_min_files
+
+logger = logging.getLogger(__name__)
+
+PARTITION_COLUMN = "date"
+KEY_COLUMN = "job_url"
+# Partition for the jobs without a posting date, same name Hive uses for null partition values
+DEFAULT_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+def partition_dir(directory: str, partition_value: str) -> str:
+    return os.path.join(directory, f"{PARTITION_COLUMN}={partition_value or DEFAULT_PARTITION}")
+
+
+def partition_files(directory: str, partition_value: str) -> list[str]:
+    return sorted(glob.glob(os.path.join(partition_dir(directory, partition_value), "*.parquet")))
+
+
+def new_file_name(prefix: str = "part") -> str:
+    return f"{prefix}-{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet"
+
+
+def append_to_dataset(df: pl.DataFrame, directory: str = dataset_dir) -> int:
+    """
+    Appends the rows of df to the dataset, one new file per posting date partition.
+    Rows whose job_url is already stored in their partition are skipped.
+
+    The date column is not written in the files, it is the partition directory name
+    and comes back as a column when the dataset is scanned with hive partitioning.
+
+    Returns:
+        int: Number of rows written.
+    """
+    df = df.unique(subset=KEY_COLUMN, keep='last')
+    written = 0
+    for (partition_value,), df_partition in df.group_by([PARTITION_COLUMN]):
+        files = partition_files(directory, partition_value)
+        if files:
+            known_urls = pl.scan_parquet(files).select(KEY_COLUMN).collect()[KEY_COLUMN]
+            df_partition = df_partition.filter(~pl.col(KEY_COLUMN).is_in(known_urls))
+        if df_partition.is_empty():
+            continue
+
+        os.makedirs(partition_dir(directory, partition_value), exist_ok=True)
+        df_partition.drop(PARTITION_COLUMN).write_parquet(
+            os.path.join(partition_dir(directory, partition_value), new_file_name()))
+        written += len(df_partition)
+
+    logger.info(f"Appended {written} new rows to dataset {directory}")
+    return written
+
+
+def compact_partition(directory: str, partition_value: str):
+    """Merges the files of a partition into one, deduplicated on job_url and sorted by company."""
+    files = partition_files(directory, partition_value)
+    # Later files have newer data, keep the last row of each job_url
+    df = (pl.concat([pl.read_parquet(f) for f in files], how='diagonal_relaxed')
+          .unique(subset=KEY_COLUMN, keep='last', maintain_order=True)
+          .sort('company'))
+
+    # Write the merged file first, the old ones are only removed once it exists
+    df.write_parquet(os.path.join(partition_dir(directory, partition_value), new_file_name("compacted")))
+    for f in files:
+        os.remove(f)
+    logger.info(f"Compacted {len(files)} files into 1 ({len(df)} rows) in partition {partition_value}")
+
+
+def compact_dataset(directory: str = dataset_dir, min_files: int = compaction_min_files):
+    """Compacts every partition that has at least min_files files."""
+    for path in sorted(glob.glob(os.path.join(directory, f"{PARTITION_COLUMN}=*"))):
+        partition_value = os.path.basename(path).split('=', 1)[1]
+        if len(partition_files(directory, partition_value)) >= min_files:
+            compact_partition(directory, partition_value)
+
+
+def scan_dataset(directory: str = dataset_dir) -> pl.LazyFrame:
+    """
+    Lazily scans the dataset. Filters on the date column only read the matching
+    partitions, e.g. scan_dataset().filter(pl.col('date') >= date(2025, 5, 1)).
+    """
+    return pl.scan_parquet(os.path.join(directory, "**", "*.parquet"), hive_partitioning=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Compacts the partitions of the jobs Parquet dataset')
+    parser.add_argument('--min-files', type=int, default=compaction_min_files,
+                        help='Compact partitions with at least this many files')
+    args = parser.parse_args()
+
+    compact_dataset(dataset_dir, args.min_files)
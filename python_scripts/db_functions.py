@@ -1,95 +1,228 @@
+import logging
+import os
+import time
 import polars as pl
 import duckdb
 
+from metrics_functions import metrics
+from schema_functions import (GENAI_TABLE_V2_SQL, clear_no_skills, create_types, create_readable_view, encode_genai,
+                              is_v1, migrate_genai_table)
+from search_functions import SearchIndex
+from summary_functions import SummaryTables
+
+logger = logging.getLogger(__name__)
+
+KEY_COLUMN = "job_url"
+
+# Table definition for each dataset
+CREATE_TABLE_SQL = {
+    'base_data': """CREATE TABLE IF NOT EXISTS {table_name}(
+                    title VARCHAR,
+                    company VARCHAR,
+                    location VARCHAR,
+                    date DATE,
+                    job_url VARCHAR PRIMARY KEY,
+                    job_description VARCHAR,
+                    seniority_level VARCHAR,
+                    employment_type VARCHAR,
+                    job_function VARCHAR,
+                    industries VARCHAR,
+                    );
+                    """,
+    # v2: ENUM columns and skills as a bitmask, see schema_functions
+    'genai_data': GENAI_TABLE_V2_SQL,
+}
+
+# Default table of each dataset
+DATASET_TABLES = {
+    'base_data': 'base_table',
+    'genai_data': 'genai_table',
+}
+
+
+class JobStore:
+    """
+    Holds a single DuckDB connection for the whole run and upserts DataFrames into it.
+
+    The batches are handed to DuckDB as Arrow tables (no copy of the data) and every
+    upsert runs inside its own transaction, so a failed batch leaves the table untouched
+    and the error is raised to the caller. The summary tables are updated in the same
+    transaction with the upserted rows, and so is the keyword search index for base_table.
+
+    Args:
+        db_file (str): Path to the DuckDB file.
+    """
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self.conn = duckdb.connect(database=db_file, read_only=False)
+        create_types(self.conn)
+        for dataset, table_name in DATASET_TABLES.items():
+            self.conn.execute(CREATE_TABLE_SQL[dataset].format(table_name=table_name))
+        if is_v1(self.conn):
+            migrate_genai_table(self.conn)
+        create_readable_view(self.conn)
+        self.summaries = SummaryTables(self.conn)
+        self._clear_no_skills()
+        self.search_index = SearchIndex(self.conn)
+        # Upsert SQL by (table, columns), built once and reused for every batch
+        self.upsert_sql: dict[tuple, str] = {}
+        self.write_stats: list[dict] = []
+
+    def _clear_no_skills(self):
+        """One-off cleanup of the rows classified before no skills became an empty list."""
+        self.conn.begin()
+        try:
+            cleared = clear_no_skills(self.conn)
+            if cleared:
+                self.summaries.rebuild()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        if cleared:
+            logger.info(f"Cleared the no skills value of {cleared} rows of genai_table")
+
+    def _get_upsert_sql(self, table_name: str, columns: tuple) -> str:
+        key = (table_name, columns)
+        if key not in self.upsert_sql:
+            all_columns_sql = ', '.join(f'"{c}"' for c in columns) # Quote column names
+            columns_to_update = [col for col in columns if col != KEY_COLUMN]
+            if columns_to_update:
+                # The `excluded` keyword refers to the row that failed to be inserted due to the conflict
+                update_setters = ', '.join(f'"{col}" = excluded."{col}"' for col in columns_to_update)
+                on_conflict = f"DO UPDATE SET {update_setters}"
+            else:
+                on_conflict = "DO NOTHING"
+            self.upsert_sql[key] = f"""
+                INSERT INTO {table_name} ({all_columns_sql})
+                SELECT {all_columns_sql} FROM upsert_batch
+                ON CONFLICT ({KEY_COLUMN}) {on_conflict};
+                """
+        return self.upsert_sql[key]
+
+    def upsert(self, df: pl.DataFrame, table_name: str, dataset: str) -> int:
+        """
+        Inserts or updates the rows of df in table_name on the job_url key.
+
+        Args:
+            df (pl.DataFrame): The rows to upsert.
+            table_name (str): Target table.
+            dataset (str): 'base_data' or 'genai_data', defines the table schema.
+
+        Returns:
+            int: Number of rows written.
+
+        Raises:
+            ValueError: If a GenAI row has a value outside the allowed sets.
+            duckdb.Error: If the upsert fails, the transaction is rolled back first.
+        """
+        if df.is_empty():
+            return 0
+
+        start = time.perf_counter()
+        if dataset == 'genai_data':
+            # Rejects values outside the allowed sets before writing, the ENUM columns would also fail
+            df = encode_genai(df)
+        if table_name not in DATASET_TABLES.values():
+            self.conn.execute(CREATE_TABLE_SQL[dataset].format(table_name=table_name))
+        sql = self._get_upsert_sql(table_name, tuple(df.columns))
+
+        self.conn.register("upsert_batch", df.to_arrow())
+        try:
+            self.conn.begin()
+            # Only the default tables feed the summaries
+            track_summaries = table_name in DATASET_TABLES.values()
+            if track_summaries:
+                self.summaries.apply("upsert_batch", -1)
+            self.conn.execute(sql)
+            if track_summaries:
+                self.summaries.apply("upsert_batch", 1)
+            if table_name == DATASET_TABLES['base_data']:
+                self.search_index.apply("upsert_batch")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self.conn.unregister("upsert_batch")
+
+        elapsed = time.perf_counter() - start
+        elapsed_ms = elapsed * 1000
+        self.write_stats.append({'table': table_name, 'rows': len(df), 'ms': elapsed_ms})
+        metrics.add_time('db_write', elapsed)
+        metrics.incr(f'rows_upserted_{table_name}', len(df))
+        logger.info(f"Upserted {len(df)} rows into '{table_name}' in {elapsed_ms:.1f} ms",
+                    extra={'table': table_name, 'rows': len(df), 'ms': round(elapsed_ms, 1)})
+        return len(df)
+
+    def get_known_job_urls(self) -> tuple[set, set]:
+        """Returns the job_urls in base_table (already scraped) and in genai_table (already classified)."""
+        scraped_urls = {row[0] for row in self.conn.execute("SELECT job_url FROM base_table").fetchall()}
+        classified_urls = {row[0] for row in self.conn.execute("SELECT job_url FROM genai_table").fetchall()}
+        logger.info(f"Known jobs: {len(scraped_urls)} scraped, {len(classified_urls)} classified")
+        return scraped_urls, classified_urls
+
+    def get_unclassified_jobs(self) -> pl.DataFrame:
+        """Returns job_url and job_description of the jobs in base_table without a row in genai_table."""
+        return self.conn.execute("""SELECT b.job_url, b.job_description FROM base_table b
+                                    ANTI JOIN genai_table g ON b.job_url = g.job_url""").pl()
+
+    def summary(self) -> dict:
+        """Rows written and total milliseconds per table during this run."""
+        summary = {}
+        for stat in self.write_stats:
+            table = summary.setdefault(stat['table'], {'writes': 0, 'rows': 0, 'ms': 0.0})
+            table['writes'] += 1
+            table['rows'] += stat['rows']
+            table['ms'] += stat['ms']
+        return summary
+
+    def close(self):
+        self.conn.close()
+
+
 def insert_into_db(df: pl.DataFrame,
                    table_name: str,
                    db_file: str,
                    dataset: str):
-    
-    # --- Configuration ---
-    key_column = "job_url" # IMPORTANT: Set your unique key column name here
-
-    # --- Connect to DuckDB ---
-    conn = duckdb.connect(database=db_file, read_only=False)
-
-    # --- Upsert Logic ---
-    print(f"\n--- Performing UPSERT for table '{table_name}' on key '{key_column}' ---")
-
-    # 1. Register the DataFrame to upsert as a view
-    view_name = "df_upsert_view" # Use a unique view name
-    conn.register(view_name, df)
-    print(f"Registered DataFrame as view '{view_name}'")
-
-    # 2. Ensure the target table exists (create if not)
-    #    This uses the schema from the view/DataFrame
-    #    LIMIT 0 creates the structure without inserting data initially
-    if dataset == 'base_data':
-        sql_create_if_not_exists = f"""CREATE TABLE IF NOT EXISTS {table_name}(
-                                    title VARCHAR,          
-                                    company VARCHAR,
-                                    location VARCHAR,
-                                    date DATE,
-                                    job_url VARCHAR PRIMARY KEY,
-                                    job_description VARCHAR,
-                                    seniority_level VARCHAR,
-                                    employment_type VARCHAR,
-                                    job_function VARCHAR,
-                                    industries VARCHAR,
-                                    );
-                                    """
-    elif dataset == 'genai_data':
-        sql_create_if_not_exists = f"""CREATE TABLE IF NOT EXISTS {table_name}(
-                                    job_url VARCHAR PRIMARY KEY,
-                                    task_clarity VARCHAR,
-                                    seniority_level_ai VARCHAR,
-                                    requires_degree_it VARCHAR,
-                                    mentions_certifications VARCHAR,
-                                    years_of_experience VARCHAR,
-                                    is_in_english VARCHAR,
-                                    cloud_preference VARCHAR,
-                                    skills_mentioned VARCHAR[]
-                                    );
-                                    """        
-    conn.execute(sql_create_if_not_exists)
-    print(f"Executed: {sql_create_if_not_exists} (if table didn't exist)")
-
-    # 3. Construct the UPSERT SQL statement
-    all_columns = df.columns
-    columns_to_update = [col for col in all_columns if col != key_column]
-
-    if not columns_to_update:
-        print("Warning: No columns to update specified (only key column found). Performing INSERT only.")
-        # Fallback to simple insert if only key column exists
-        sql_upsert = f"""
-            INSERT INTO {table_name} ({', '.join(all_columns)})
-            SELECT {', '.join(all_columns)} FROM {view_name}
-            ON CONFLICT ({key_column}) DO NOTHING;
-        """
-    else:
-        # Prepare column lists for SQL
-        all_columns_sql = ', '.join(f'"{c}"' for c in all_columns) # Quote column names
-        update_setters = ', '.join([f'"{col}" = excluded."{col}"' for col in columns_to_update])
-
-        sql_upsert = f"""
-        INSERT INTO {table_name} ({all_columns_sql})
-        SELECT {all_columns_sql} FROM {view_name}
-        ON CONFLICT ({key_column}) DO UPDATE SET
-            {update_setters};
-        """
-        # The `excluded` keyword refers to the row that *failed* to be inserted
-        # due to the conflict, allowing you to use its values in the UPDATE.
+    """One-off upsert that opens and closes its own connection, see JobStore for repeated writes."""
+    store = JobStore(db_file)
+    try:
+        store.upsert(df, table_name, dataset)
+    finally:
+        store.close()
+
+
+def get_known_job_urls(db_file: str) -> tuple[set, set]:
+    """
+    Loads the job_urls already stored in the database.
+
+    Args:
+        db_file (str): Path to the DuckDB file.
+
+    Returns:
+        tuple[set, set]: The job_urls in base_table (already scraped) and the ones
+        in genai_table (already classified).
+    """
+    if not os.path.exists(db_file):
+        logger.info(f"Database {db_file} doesn't exist yet, no known jobs")
+        return set(), set()
+
+    store = JobStore(db_file)
+    try:
+        return store.get_known_job_urls()
+    finally:
+        store.close()
+
 
-    print(f"\nExecuting UPSERT SQL:\n{sql_upsert}")
+def get_unclassified_jobs(db_file: str) -> pl.DataFrame:
+    """
+    Returns the job_url and job_description of the jobs in base_table that have
+    no row in genai_table yet.
+    """
+    store = JobStore(db_file)
     try:
-        conn.execute(sql_upsert)
-        print("UPSERT execution successful.")
-    except Exception as e:
-        print(f"Error during UPSERT execution: {e}")
-
-    # 4. Clean up the temporary view
-    conn.unregister(view_name)
-    print(f"Unregistered view '{view_name}'")
-
-    # --- Close Connection ---
-    conn.close()
-    print("\nConnection closed.")
\ No newline at end of file
+        return store.get_unclassified_jobs()
+    finally:
+        store.close()
@@ -0,0 +1,216 @@
+import hashlib
+import logging
+import random
+
+import duckdb
+import polars as pl
+
+from cache_functions import normalize_description
+from config import (near_duplicate_num_perm, near_duplicate_bands, near_duplicate_threshold,
+                    near_duplicate_shingle_size)
+
+logger = logging.getLogger(__name__)
+
+MERSENNE_PRIME = (1 << 61) - 1
+# Descriptions shorter than this (in words) are not checked, e.g. "Could not find Job Description"
+MIN_WORDS = 20
+
+
+def hash64(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+class NearDuplicateIndex:
+    """
+    Finds reposts of the same job under a new job_url with MinHash signatures over
+    word shingles of the description, and LSH banding to look up candidates.
+
+    Signatures and bands are stored in DuckDB (near_duplicates and lsh_buckets), so new
+    postings are compared against all history by looking up only the postings that share
+    a band. Each posting is linked to its canonical posting, itself if it is not a duplicate.
+
+    Args:
+        conn (duckdb.DuckDBPyConnection): Connection to the project database, e.g. JobStore.conn.
+        num_perm (int): Number of MinHash permutations.
+        bands (int): Number of LSH bands, num_perm must be divisible by it.
+        threshold (float): Minimum estimated Jaccard similarity to be a duplicate.
+        shingle_size (int): Words per shingle.
+        read_only (bool): Don't create the tables and indexes, for lookups on a read-only
+            connection with find_duplicates.
+    """
+
+    def __init__(self,
+                 conn,
+                 num_perm: int = near_duplicate_num_perm,
+                 bands: int = near_duplicate_bands,
+                 threshold: float = near_duplicate_threshold,
+                 shingle_size: int = near_duplicate_shingle_size,
+                 read_only: bool = False):
+        self.conn = conn
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        # Fixed seed, signatures must be comparable across runs
+        rng = random.Random(42)
+        self.permutations = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+                             for _ in range(num_perm)]
+        if read_only:
+            return
+
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS near_duplicates(
+                             job_url VARCHAR PRIMARY KEY,
+                             canonical_url VARCHAR,
+                             similarity DOUBLE,
+                             signature UBIGINT[]
+                             );
+                             """)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS lsh_buckets(
+                             band USMALLINT,
+                             bucket UBIGINT,
+                             job_url VARCHAR
+                             );
+                             """)
+        # DuckDB only uses single column indexes for lookups, so buckets are looked up by bucket alone
+        self.conn.execute("DROP INDEX IF EXISTS lsh_buckets_idx;")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS lsh_buckets_bucket_idx ON lsh_buckets(bucket);")
+
+    def signature(self, job_description: str) -> list[int] | None:
+        """MinHash signature of the description, None if it is too short to compare."""
+        words = normalize_description(job_description).split(' ')
+        if len(words) < max(MIN_WORDS, self.shingle_size):
+            return None
+        shingles = {hash64(' '.join(words[i:i + self.shingle_size]).encode('utf-8')) % MERSENNE_PRIME
+                    for i in range(len(words) - self.shingle_size + 1)}
+        return [min((a * x + b) % MERSENNE_PRIME for x in shingles) for a, b in self.permutations]
+
+    def band_buckets(self, signature: list[int]) -> list[tuple[int, int]]:
+        buckets = []
+        for band in range(self.bands):
+            rows = signature[band * self.rows_per_band:(band + 1) * self.rows_per_band]
+            buckets.append((band, hash64(','.join(map(str, rows)).encode('ascii'))))
+        return buckets
+
+    @staticmethod
+    def similarity(signature_a: list[int], signature_b: list[int]) -> float:
+        """Estimated Jaccard similarity of two signatures."""
+        return sum(a == b for a, b in zip(signature_a, signature_b)) / len(signature_a)
+
+    def find_canonical(self, signature: list[int]) -> tuple[str, float] | None:
+        """
+        Returns the most similar indexed posting above the threshold and its similarity.
+
+        Both lookups are equalities on an indexed column (one per band on lsh_buckets.bucket,
+        then the near_duplicates primary key), which DuckDB answers with index scans, so the
+        cost depends on the number of candidates and not on the size of the history. The
+        band is checked here, a filter on it would turn the lookups into sequential scans.
+        """
+        buckets = set(self.band_buckets(signature))
+        rows = self.conn.execute(' UNION ALL '.join(["SELECT job_url, band, bucket FROM lsh_buckets WHERE bucket = ?::UBIGINT"] * len(buckets)),
+                                 [bucket for _, bucket in buckets]).fetchall()
+        candidate_urls = list({job_url for job_url, band, bucket in rows if (band, bucket) in buckets})
+        if not candidate_urls:
+            return None
+        candidates = self.conn.execute(f"""SELECT job_url, signature FROM near_duplicates
+                                           WHERE job_url IN ({', '.join(['?'] * len(candidate_urls))})""",
+                                       candidate_urls).fetchall()
+        best = None
+        for job_url, candidate_signature in candidates:
+            score = self.similarity(signature, candidate_signature)
+            if score >= self.threshold and (best is None or score > best[1]):
+                best = (job_url, score)
+        return best
+
+    def assign(self, df: pl.DataFrame) -> dict:
+        """
+        Links every posting in df (job_url, job_description) to its canonical posting
+        and indexes the new canonical postings, so later rows of the same batch are
+        also compared against them.
+
+        Returns:
+            dict: job_url -> canonical_url for the postings that are near duplicates.
+        """
+        duplicates = {}
+        for job_url, job_description in df.select('job_url', 'job_description').iter_rows():
+            known = self.conn.execute("SELECT canonical_url FROM near_duplicates WHERE job_url = ?",
+                                      [job_url]).fetchone()
+            if known is not None:
+                if known[0] != job_url:
+                    duplicates[job_url] = known[0]
+                continue
+
+            signature = self.signature(job_description)
+            if signature is None:
+                continue
+            match = self.find_canonical(signature)
+            if match is None:
+                # New canonical posting, only these go into the LSH buckets
+                self.conn.execute("INSERT INTO near_duplicates VALUES (?, ?, 1.0, ?)", [job_url, job_url, signature])
+                self.conn.executemany("INSERT INTO lsh_buckets VALUES (?, ?, ?)",
+                                      [[band, bucket, job_url] for band, bucket in self.band_buckets(signature)])
+            else:
+                canonical_url, score = match
+                self.conn.execute("INSERT INTO near_duplicates VALUES (?, ?, ?, ?)",
+                                  [job_url, canonical_url, score, signature])
+                duplicates[job_url] = canonical_url
+
+        logger.info(f"Near duplicates: {len(duplicates)} of {len(df)} postings are reposts of a canonical posting")
+        return duplicates
+
+    def find_duplicates(self, df: pl.DataFrame) -> dict:
+        """
+        Looks up the canonical posting of every posting in df (job_url, job_description) in the
+        indexed history without writing to the DB, so it works on a read-only connection while
+        another process owns the writes. The postings of df aren't compared with each other,
+        assign does it when they are stored.
+
+        Returns:
+            dict: job_url -> canonical_url for the postings that are near duplicates.
+        """
+        duplicates = {}
+        try:
+            for job_url, job_description in df.select('job_url', 'job_description').iter_rows():
+                known = self.conn.execute("SELECT canonical_url FROM near_duplicates WHERE job_url = ?",
+                                          [job_url]).fetchone()
+                if known is not None:
+                    if known[0] != job_url:
+                        duplicates[job_url] = known[0]
+                    continue
+
+                signature = self.signature(job_description)
+                if signature is None:
+                    continue
+                match = self.find_canonical(signature)
+                if match is not None:
+                    duplicates[job_url] = match[0]
+        except duckdb.CatalogException:
+            # The tables are created by the first NearDuplicateIndex on a read-write connection
+            return {}
+
+        logger.info(f"Near duplicates: {len(duplicates)} of {len(df)} postings are reposts of an indexed posting")
+        return duplicates
+
+    def copy_classifications(self, store) -> int:
+        """
+        Gives every unclassified duplicate the classification of its canonical posting.
+
+        Args:
+            store (JobStore): Store on the same connection, the copies go through its upsert
+                so the summary tables count them.
+
+        Returns:
+            int: Number of classifications copied.
+        """
+        df = self.conn.execute("""SELECT n.job_url, g.* EXCLUDE (job_url)
+                                  FROM near_duplicates n JOIN genai_table g ON g.job_url = n.canonical_url
+                                  WHERE n.job_url <> n.canonical_url
+                                    AND n.job_url NOT IN (SELECT job_url FROM genai_table)""").pl()
+        copied = store.upsert(df, 'genai_table', 'genai_data')
+        logger.info(f"Copied {copied} classifications from canonical postings to their duplicates")
+        return copied
+
+    def count_distinct_roles(self) -> int:
+        """Number of distinct roles in base_table, counting each group of reposts once."""
+        return self.conn.execute("""SELECT count(DISTINCT coalesce(n.canonical_url, b.job_url))
+                                    FROM base_table b LEFT JOIN near_duplicates n ON b.job_url = n.job_url""").fetchone()[0]
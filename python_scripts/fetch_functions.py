@@ -0,0 +1,177 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from archive_functions import HtmlArchive
+from metrics_functions import metrics
+from config import (fetch_max_workers, fetch_requests_per_second, fetch_burst,
+                    fetch_max_retries, fetch_backoff_seconds, fetch_timeout, archive_enabled)
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"
+
+# Status codes that are worth retrying (rate limited or server side errors)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Simple thread-safe token bucket used to space out requests (to a single host, or to an API quota).
+
+    Args:
+        rate (float): Tokens added per second.
+        capacity (int): Maximum number of tokens (burst size).
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1):
+        """Blocks until the requested tokens are available and consumes them."""
+        # A request bigger than the bucket would wait forever, cap it to a full bucket
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Fetcher:
+    """
+    HTTP client that reuses keep-alive connections and rate limits each host
+    with its own token bucket.
+
+    Args:
+        max_workers (int): Maximum number of concurrent requests.
+        requests_per_second (float): Allowed request rate per host.
+        burst (int): Number of requests a host can receive back to back.
+        max_retries (int): Attempts per URL before giving up.
+        backoff_seconds (float): Base delay for the exponential backoff between retries.
+        timeout (float): Timeout in seconds for each request.
+        archive (HtmlArchive): Optional archive where every successful response is stored.
+    """
+
+    def __init__(self,
+                 max_workers: int = fetch_max_workers,
+                 requests_per_second: float = fetch_requests_per_second,
+                 burst: int = fetch_burst,
+                 max_retries: int = fetch_max_retries,
+                 backoff_seconds: float = fetch_backoff_seconds,
+                 timeout: float = fetch_timeout,
+                 archive: HtmlArchive = None):
+        self.max_workers = max_workers
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout = timeout
+        self.archive = archive
+
+        self.session = requests.Session()
+        self.session.headers.update({"User-Agent": USER_AGENT})
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.buckets: dict[str, TokenBucket] = {}
+        self.buckets_lock = threading.Lock()
+
+    def _bucket_for(self, url: str) -> TokenBucket:
+        host = urlparse(url).netloc
+        with self.buckets_lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.requests_per_second, self.burst)
+            return self.buckets[host]
+
+    def get(self, url: str) -> requests.Response:
+        """
+        Fetches a URL respecting the host rate limit, retrying with exponential
+        backoff and jitter on connection errors and retryable status codes.
+
+        Returns:
+            requests.Response: The successful (2xx) response.
+
+        Raises:
+            requests.HTTPError: If the last response is not a 2xx (e.g. still 429 after every
+                retry), so error pages are never parsed as postings.
+            requests.RequestException: If every attempt failed with a connection error.
+        """
+        bucket = self._bucket_for(url)
+        for attempt in range(self.max_retries):
+            with metrics.timer('fetch_rate_limit_wait'):
+                bucket.acquire()
+            try:
+                with metrics.timer('fetch'):
+                    r = self.session.get(url, timeout=self.timeout)
+            except requests.RequestException as e:
+                metrics.incr('fetch_errors')
+                if attempt == self.max_retries - 1:
+                    raise
+                logger.warning(f"Request error for {url} (attempt {attempt + 1}/{self.max_retries}): {e}",
+                               extra={'url': url, 'attempt': attempt + 1})
+            else:
+                metrics.incr(f'http_status_{r.status_code}')
+                if r.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries - 1:
+                    metrics.incr('pages_fetched')
+                    metrics.incr('bytes_fetched', len(r.content))
+                    if not 200 <= r.status_code < 300:
+                        raise requests.HTTPError(f"Status {r.status_code} for {url} after {attempt + 1} attempts", response=r)
+                    if self.archive is not None and r.status_code == 200:
+                        self.archive.write(url, r.status_code, r.content)
+                    return r
+                logger.warning(f"Got status {r.status_code} for {url} (attempt {attempt + 1}/{self.max_retries})",
+                               extra={'url': url, 'status_code': r.status_code, 'attempt': attempt + 1})
+            metrics.incr('fetch_retries')
+            with metrics.timer('fetch_backoff'):
+                time.sleep(self.backoff_seconds * 2 ** attempt + random.uniform(0, 1))
+
+    def map(self, func, urls: list[str]) -> list:
+        """
+        Fetches every URL concurrently and applies func(url, response) to each one.
+
+        Results are returned in the same order as urls. If fetching or func raises,
+        the exception object is returned in place of the result so the caller can
+        decide what to do with that URL.
+        """
+        def task(url):
+            try:
+                return func(url, self.get(url))
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(task, urls))
+
+
+_fetcher = None
+
+
+def get_fetcher() -> Fetcher:
+    """Returns the shared Fetcher, creating it on first use."""
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = Fetcher(archive=HtmlArchive() if archive_enabled else None)
+    return _fetcher
+
+
+def set_fetcher(fetcher):
+    """Replaces the shared Fetcher, e.g. with an archive_functions.ReplayFetcher."""
+    global _fetcher
+    _fetcher = fetcher
@@ -1,13 +1,50 @@
-import google.generativeai as genai
-from config import API_KEY, model_version
+import logging
+from google.api_core import exceptions as google_exceptions
+from config import (API_KEY, model_version, llm_max_workers, llm_requests_per_minute,
+                    llm_tokens_per_minute, llm_max_retries, llm_backoff_seconds, use_rules,
+                    rules_confidence_threshold)
+from fetch_functions import TokenBucket
+from metrics_functions import metrics
+from rules_functions import RULES_VERSION, confident_fields
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
 import time
 import json
 
-# Configure the Gemini API client
-genai.configure(api_key=API_KEY)
+logger = logging.getLogger(__name__)
+
+# Gemini model, created by get_model on first use so importing this module doesn't load the SDK
+model = None
+model_lock = threading.Lock()
+
+
+def get_model():
+    """Returns the Gemini model, configuring the API client the first time."""
+    global model
+    with model_lock:
+        if model is None:
+            import google.generativeai as genai
+            genai.configure(api_key=API_KEY)
+            model = genai.GenerativeModel(model_version)
+    return model
+
+
+# Bump this whenever the prompt or the allowed values change, it invalidates the cached classifications.
+# Cached entries are also validated when read, an invalid one is classified again.
+PROMPT_VERSION = "2"
+
+
+def classification_version(use_rules: bool = use_rules, threshold: float = rules_confidence_threshold) -> str:
+    """
+    Version the cached classifications are stored under: the prompt version, plus the rules
+    version and threshold when the rules fill part of the fields, so pure LLM classifications
+    and rules + LLM ones don't share entries.
+    """
+    if not use_rules:
+        return PROMPT_VERSION
+    return f"{PROMPT_VERSION}+rules{RULES_VERSION}@{threshold}"
 
-# Choose the Gemini model
-model = genai.GenerativeModel(model_version)
 
 # Serionity levels
 SENIORITY_LEVELS = ["Junior", "Mid-Senior", "Senior", "Lead or greater"]
@@ -34,6 +71,9 @@ SKILLS_WANTED  = ["Databricks or snowflake",
                  "Spark knowledge",
                  "None of the above mentioned skills",
                  ]
+# Kept in SKILLS_WANTED so the skills_mask bits don't move, but no skills is stored as an empty
+# list: it's not offered to the LLM and normalize_skills drops it from older answers
+NO_SKILLS = "None of the above mentioned skills"
 
 EXPECTED_KEYS = [
     "task_clarity",
@@ -46,6 +86,195 @@ EXPECTED_KEYS = [
     "skills_mentioned" 
 ]
 
+# Allowed values for each categorical key, used to validate the LLM output
+ALLOWED_VALUES = {
+    "task_clarity": CLARITY_LEVELS,
+    "seniority_level_ai": SENIORITY_LEVELS,
+    "requires_degree_it": REQUIRES_DEGREE_IT,
+    "mentions_certifications": MENTIONS_CERTIFICATIONS,
+    "years_of_experience": YEARS_OF_EXPERIENCE,
+    "is_in_english": IN_ENGLISH,
+    "cloud_preference": CLOUD_PREFERENCES,
+}
+
+# Criteria for each key, shared by the single and the batch prompts
+CRITERIA = {
+    "task_clarity": f"""How clear are the specific tasks and responsibilities?
+        Allowed values: {CLARITY_LEVELS}""",
+    "seniority_level_ai": f"""What is the implied seniority based on the description?
+        Allowed values: {SENIORITY_LEVELS}
+        Interpret context (e.g., "lead role", "entry-level").""",
+    "requires_degree_it": f"""Does it explicitly require a Bachelor's or higher degree in IT, Computer Science, or a related STEM field?
+        Allowed values: {REQUIRES_DEGREE_IT}
+        If not mentioned, use "No".""",
+    "mentions_certifications": f"""Does it mention specific certifications (e.g., AWS Certified, Azure Data Engineer, PMP) as required or preferred?
+        Allowed values: {MENTIONS_CERTIFICATIONS}""",
+    "years_of_experience": f"""What is the minimum years of experience mentioned?
+        Allowed values: {YEARS_OF_EXPERIENCE}
+        Interpret phrases like "at least 3 years" as "3", "5-7 years" as "5". If not mentioned, use "Not Specified".""",
+    "is_in_english": f"""Is the primary language of the description English or its mentioned that the job will need you to communicate in English?.
+        Allowed values: {IN_ENGLISH}""",
+    "cloud_preference": f"""What is the main cloud platform focus?
+        Allowed values: {CLOUD_PREFERENCES}
+        Prioritize: Specific cloud (AWS/Azure/GCP) > Multiple Clouds > Other Cloud > No Preference (if cloud mentioned but general) > No Mention.""",
+    "skills_mentioned": f"""Identify which skills from the provided list are mentioned or strongly implied in the description. Output these as a JSON list of strings.
+        Skill list: {[skill for skill in SKILLS_WANTED if skill != NO_SKILLS]}
+        If none from the list are clearly mentioned, provide an empty list [].""",
+}
+
+# Example outputs shown in the prompts
+EXAMPLE_CLASSIFICATIONS = [
+    {
+        "task_clarity": "Medium",
+        "seniority_level_ai": "Senior",
+        "requires_degree_it": "Yes",
+        "mentions_certifications": "No",
+        "years_of_experience": "5",
+        "is_in_english": "Yes",
+        "cloud_preference": "AWS",
+        "skills_mentioned": ["Develop pipelines or ETL/ELT processes", "APIs", "Migration"],
+    },
+    {
+        "task_clarity": "High",
+        "seniority_level_ai": "Junior",
+        "requires_degree_it": "No",
+        "mentions_certifications": "No",
+        "years_of_experience": "Not Specified",
+        "is_in_english": "No",
+        "cloud_preference": "No Mention",
+        "skills_mentioned": [],
+    },
+]
+
+
+def build_criteria_prompt(keys: list[str] = EXPECTED_KEYS) -> str:
+    """Numbered criteria block for the given keys."""
+    criteria = "\n".join(f'    {n}.  "{key}": {CRITERIA[key]}' for n, key in enumerate(keys, start=1))
+    return f"""    Classification Criteria and Allowed Values:
+
+{criteria}
+"""
+
+
+def build_example(keys: list[str] = EXPECTED_KEYS, with_ids: bool = False) -> str:
+    """Example JSON output restricted to the given keys, an array of two objects with ids for batches."""
+    if with_ids:
+        example = [{"id": str(n), **{key: e[key] for key in keys}} for n, e in enumerate(EXAMPLE_CLASSIFICATIONS)]
+    else:
+        example = {key: EXAMPLE_CLASSIFICATIONS[0][key] for key in keys}
+    return "\n".join(f"    {line}" for line in json.dumps(example, indent=2).splitlines())
+
+
+# Errors worth retrying: rate limited (429) or server side errors (5xx)
+RETRYABLE_ERRORS = (google_exceptions.TooManyRequests, google_exceptions.ServerError)
+
+
+class LLMExecutor:
+    """
+    Runs Gemini calls in parallel while keeping under the requests-per-minute and
+    tokens-per-minute quotas with two token buckets. Calls that fail with 429 or 5xx
+    are retried with exponential backoff and jitter, any other error is raised.
+
+    Args:
+        max_workers (int): Maximum number of concurrent calls.
+        requests_per_minute (int): Requests allowed per minute.
+        tokens_per_minute (int): Input tokens allowed per minute.
+        max_retries (int): Attempts per call before giving up.
+        backoff_seconds (float): Base delay for the exponential backoff.
+    """
+
+    def __init__(self,
+                 max_workers: int = llm_max_workers,
+                 requests_per_minute: int = llm_requests_per_minute,
+                 tokens_per_minute: int = llm_tokens_per_minute,
+                 max_retries: int = llm_max_retries,
+                 backoff_seconds: float = llm_backoff_seconds):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.request_bucket = TokenBucket(requests_per_minute / 60, max(1, requests_per_minute // 60))
+        self.token_bucket = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+        self.latencies: list[float] = []
+        self.latencies_lock = threading.Lock()
+
+    @staticmethod
+    def estimate_tokens(prompt: str) -> int:
+        # Rough estimate, about 4 characters per token
+        return len(prompt) // 4 + 1
+
+    def generate(self, prompt: str) -> str:
+        """Calls Gemini with the prompt and returns the text of the response."""
+        for attempt in range(self.max_retries):
+            with metrics.timer('llm_rate_limit_wait'):
+                self.request_bucket.acquire()
+                self.token_bucket.acquire(self.estimate_tokens(prompt))
+            metrics.incr('llm_calls')
+            start = time.perf_counter()
+            try:
+                response = get_model().generate_content(prompt)
+                self._record_latency(start)
+                self._record_usage(response)
+                return response.text
+            except RETRYABLE_ERRORS as e:
+                self._record_latency(start)
+                if attempt == self.max_retries - 1:
+                    raise
+                metrics.incr('llm_retries')
+                wait = self.backoff_seconds * 2 ** attempt + random.uniform(0, 1)
+                logger.warning(f"Gemini API returned {e.code} (attempt {attempt + 1}/{self.max_retries}), retrying in {wait:.1f} seconds...",
+                               extra={'status_code': e.code, 'attempt': attempt + 1})
+                time.sleep(wait)
+
+    def _record_latency(self, start: float):
+        elapsed = time.perf_counter() - start
+        metrics.add_time('llm', elapsed)
+        with self.latencies_lock:
+            self.latencies.append(elapsed)
+
+    @staticmethod
+    def _record_usage(response):
+        # Token counts reported by the API, missing in older SDK versions
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is not None:
+            metrics.incr('llm_tokens_in', getattr(usage, 'prompt_token_count', 0) or 0)
+            metrics.incr('llm_tokens_out', getattr(usage, 'candidates_token_count', 0) or 0)
+
+    def map(self, func, items: list) -> list:
+        """Applies func to every item in parallel, results are returned in the same order as items."""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(func, items))
+
+    def latency_stats(self) -> dict:
+        """Number of calls and latency percentiles in seconds."""
+        with self.latencies_lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return {'calls': 0}
+        return {
+            'calls': len(latencies),
+            'p50': latencies[len(latencies) // 2],
+            'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            'max': latencies[-1],
+        }
+
+
+_executor = None
+
+
+def get_executor() -> LLMExecutor:
+    """Returns the shared LLMExecutor, creating it on first use."""
+    global _executor
+    if _executor is None:
+        _executor = LLMExecutor()
+    return _executor
+
+
+def set_executor(executor: LLMExecutor):
+    """Replaces the shared LLMExecutor, e.g. with one that has a share of the rate limits."""
+    global _executor
+    _executor = executor
+
+
 # --- Helper to clean potential JSON output ---
 def clean_json_string(raw_string: str) -> str:
     """Attempts to extract a JSON object from a string that might contain extra text."""
@@ -60,11 +289,46 @@ def clean_json_string(raw_string: str) -> str:
             return json_candidate
 
 
-def classify_job_description(job_description: str,
-                             delay: int = 5,
-                             max_retries: int = 3) -> str:
-    
-    prompt = f"""
+def clean_json_array_string(raw_string: str) -> str:
+    """Attempts to extract a JSON array from a string that might contain extra text."""
+    start = raw_string.find('[')
+    end = raw_string.rfind(']')
+    if start != -1 and end != -1 and end > start:
+        return raw_string[start:end+1]
+
+
+def validate_classification(parsed_json, keys: list[str] = EXPECTED_KEYS) -> list[str]:
+    """
+    Checks a parsed classification against the expected keys and the allowed values.
+
+    Returns:
+        list[str]: The problems found, empty if the classification is valid.
+    """
+    if not isinstance(parsed_json, dict):
+        return ["Parsed output is not a dictionary"]
+
+    errors = []
+    missing_keys = [key for key in keys if key not in parsed_json]
+    if missing_keys:
+        errors.append(f"Missing keys: {missing_keys}")
+    for key, allowed in ALLOWED_VALUES.items():
+        if key in parsed_json and parsed_json[key] not in allowed:
+            errors.append(f"Invalid value for {key}: {parsed_json[key]}")
+    skills = parsed_json.get("skills_mentioned", [])
+    if not isinstance(skills, list) or any(skill not in SKILLS_WANTED for skill in skills):
+        errors.append(f"Invalid skills_mentioned: {skills}")
+    return errors
+
+
+def normalize_skills(classification: dict) -> dict:
+    """Drops NO_SKILLS from skills_mentioned, a classification without skills has an empty list."""
+    if NO_SKILLS in classification.get("skills_mentioned", []):
+        classification = dict(classification, skills_mentioned=[s for s in classification["skills_mentioned"] if s != NO_SKILLS])
+    return classification
+
+
+def build_prompt(job_description: str, keys: list[str] = EXPECTED_KEYS) -> str:
+    return f"""
     Analyze the following job description based on the criteria below.
     Provide the output STRICTLY as a JSON object containing ONLY the keys specified.
     Do NOT include any introductory text, explanations, or markdown formatting like ```json.
@@ -74,53 +338,46 @@ def classify_job_description(job_description: str,
     {job_description}
     ---
 
-    Classification Criteria and Allowed Values:
+{build_criteria_prompt(keys)}
+    Required JSON Output Format (example):
+{build_example(keys)}
 
-    1.  "task_clarity": How clear are the specific tasks and responsibilities?
-        Allowed values: {CLARITY_LEVELS}
-    2.  "seniority_level_ai": What is the implied seniority based on the description?
-        Allowed values: {SENIORITY_LEVELS}
-        Interpret context (e.g., "lead role", "entry-level").
-    3.  "requires_degree_it": Does it explicitly require a Bachelor's or higher degree in IT, Computer Science, or a related STEM field?
-        Allowed values: {REQUIRES_DEGREE_IT}
-        If not mentioned, use "No".
-    4.  "mentions_certifications": Does it mention specific certifications (e.g., AWS Certified, Azure Data Engineer, PMP) as required or preferred?
-        Allowed values: {MENTIONS_CERTIFICATIONS}
-    5.  "years_of_experience": What is the minimum years of experience mentioned?
-        Allowed values: {YEARS_OF_EXPERIENCE}
-        Interpret phrases like "at least 3 years" as "3", "5-7 years" as "5". If not mentioned, use "Not Specified".
-    6.  "is_in_english": Is the primary language of the description English or its mentioned that the job will need you to communicate in English?.
-        Allowed values: {IN_ENGLISH}
-    7.  "cloud_preference": What is the main cloud platform focus?
-        Allowed values: {CLOUD_PREFERENCES}
-        Prioritize: Specific cloud (AWS/Azure/GCP) > Multiple Clouds > Other Cloud > No Preference (if cloud mentioned but general) > No Mention.
-    8.  "skills_mentioned": Identify which skills from the provided list are mentioned or strongly implied in the description. Output these as a JSON list of strings.
-        Skill list: {SKILLS_WANTED}
-        If none from the list are clearly mentioned, provide an empty list [].
+    Provide ONLY the JSON object below:
+    """
 
 
-    Required JSON Output Format (example):
-    {{
-      "task_clarity": "Medium",
-      "seniority_level_ai": "Senior",
-      "requires_degree_it": "Yes",
-      "mentions_certifications": "No",
-      "years_of_experience": "5",
-      "is_in_english": "Yes",
-      "cloud_preference": "AWS",
-      "skills_mentioned": ["Develop pipelines or ETL/ELT processes", "APIs", "Migration"]
-    }}
+def classify_job_description(job_description: str,
+                             max_retries: int = 3,
+                             cache=None,
+                             executor: LLMExecutor = None,
+                             keys: list[str] = EXPECTED_KEYS) -> str:
+    """
+    Classifies a job description with Gemini.
 
-    Provide ONLY the JSON object below:
+    Args:
+        job_description (str): The job description to classify.
+        max_retries (int): Maximum number of attempts to get a valid classification.
+        cache (ClassificationCache): Optional cache checked before calling the API,
+            successful results are written back to it. Only used with the full set of keys.
+        executor (LLMExecutor): Client used for the API calls, the shared one by default.
+        keys (list[str]): Keys to ask for, all of EXPECTED_KEYS by default.
+
+    Returns:
+        dict: The classification, or None if every attempt failed.
     """
-    
+    if cache is not None:
+        cached = cache.get(job_description)
+        if cached is not None:
+            logger.info("Classification found in cache, skipping Gemini API call.")
+            return cached
+
+    executor = executor or get_executor()
+    prompt = build_prompt(job_description, keys)
+
     for attempt in range(max_retries):
-        time.sleep(delay)
         try:
-            print(f"Attempt {attempt + 1}/{max_retries}: Calling Gemini API...")
-            response = model.generate_content(prompt)
-
-            raw_output = response.text.strip()
+            logger.info(f"Attempt {attempt + 1}/{max_retries}: Calling Gemini API...")
+            raw_output = executor.generate(prompt).strip()
             # print(f"Raw API Response (Attempt {attempt + 1}):\n{raw_output}") # Log raw response for debugging
 
             # Attempt to clean and parse the JSON
@@ -128,42 +385,193 @@ def classify_job_description(job_description: str,
             parsed_json = json.loads(cleaned_output)
 
             # --- Validation of Parsed JSON ---
-            if not isinstance(parsed_json, dict):
-                print(f"Error: Parsed output is not a dictionary. Attempt {attempt + 1}")
-                raise ValueError("Parsed output is not a dictionary") # Trigger retry or fail
-
-            # Check for missing keys (optional but recommended)
-            missing_keys = [key for key in EXPECTED_KEYS if key not in parsed_json]
-            if missing_keys:
-                 print(f"Warning: Parsed JSON is missing expected keys: {missing_keys}. Attempt {attempt + 1}")
-                 # Decide if you want to retry or accept partial data. Here we'll retry.
-                 raise ValueError(f"Missing keys in JSON response: {missing_keys}")
-
-            print(f"Successfully parsed JSON (Attempt {attempt + 1}).")
+            # Missing keys or values outside the allowed lists trigger a retry
+            errors = validate_classification(parsed_json, keys)
+            if errors:
+                logger.warning(f"Invalid classification: {errors}. Attempt {attempt + 1}")
+                raise ValueError(f"Invalid classification in JSON response: {errors}")
+
+            logger.info(f"Successfully parsed JSON (Attempt {attempt + 1}).")
+            parsed_json = normalize_skills(parsed_json)
+            if cache is not None:
+                cache.put(job_description, parsed_json)
             return parsed_json # Return the dictionary
 
         except json.JSONDecodeError as json_e:
-            print(f"API Error (Attempt {attempt + 1}/{max_retries}): Failed to decode JSON.")
-            print(f"JSONDecodeError: {json_e}")
-            print(f"Raw Response that failed parsing: {raw_output}")
+            logger.error(f"API Error (Attempt {attempt + 1}/{max_retries}): Failed to decode JSON.")
+            logger.error(f"JSONDecodeError: {json_e}")
+            logger.info(f"Raw Response that failed parsing: {raw_output}")
             # Optionally try more aggressive cleaning here if needed
             error_message = f"JSONDecodeError: {json_e}"
 
         except Exception as e:
             # Catch other potential API errors 
-            print(f"API Error (Attempt {attempt + 1}/{max_retries}): {e}")
+            logger.error(f"API Error (Attempt {attempt + 1}/{max_retries}): {e}")
             error_message = str(e)
 
         # If loop continues, it means an error occurred
         if attempt < max_retries - 1:
-            print(f"Retrying in {delay} seconds...")
-            time.sleep(delay)
+            logger.warning("Retrying...")
 
         else:
-            print("Error: Max retries reached. Failed to classify job description.")
+            logger.error("Max retries reached. Failed to classify job description.")
             # Log the last error encountered
-            print(f"Last error message: {error_message}")
+            logger.error(f"Last error message: {error_message}")
             return None # Return None after exhausting retries
 
     return None
 
+
+def build_batch_prompt(items: list[tuple[str, str]], keys: list[str] = EXPECTED_KEYS) -> str:
+    descriptions = "\n".join(f"""
+    Job Description (id: {item_id}):
+    ---
+    {job_description}
+    ---
+    """ for item_id, job_description in items)
+
+    return f"""
+    Analyze each of the following job descriptions based on the criteria below.
+    Provide the output STRICTLY as a JSON array with one object per job description.
+    Each object must contain the "id" of its job description and ONLY the keys specified.
+    Do NOT include any introductory text, explanations, or markdown formatting like ```json.
+    {descriptions}
+{build_criteria_prompt(keys)}
+    Required JSON Output Format (example for two job descriptions):
+{build_example(keys, with_ids=True)}
+
+    Provide ONLY the JSON array below:
+    """
+
+
+def classify_batch(items: list[tuple[str, str]],
+                   executor: LLMExecutor = None,
+                   keys: list[str] = EXPECTED_KEYS) -> dict:
+    """
+    Classifies several job descriptions with a single Gemini call.
+
+    Args:
+        items (list[tuple[str, str]]): Pairs of (id, job_description).
+        executor (LLMExecutor): Client used for the API call, the shared one by default.
+        keys (list[str]): Keys to ask for, all of EXPECTED_KEYS by default.
+
+    Returns:
+        dict: The valid classifications by id. Ids that are missing or invalid in
+        the response are not included.
+    """
+    executor = executor or get_executor()
+    try:
+        logger.info(f"Calling Gemini API for a batch of {len(items)} job descriptions...")
+        raw_output = executor.generate(build_batch_prompt(items, keys)).strip()
+        parsed_json = json.loads(clean_json_array_string(raw_output))
+    except Exception as e:
+        logger.error(f"API Error for batch: {e}")
+        return {}
+
+    if not isinstance(parsed_json, list):
+        logger.error("Parsed batch output is not a list.")
+        return {}
+
+    expected_ids = {item_id for item_id, _ in items}
+    results = {}
+    for element in parsed_json:
+        if not isinstance(element, dict):
+            continue
+        item_id = str(element.pop("id", ""))
+        if item_id not in expected_ids:
+            continue
+        errors = validate_classification(element, keys)
+        if errors:
+            logger.warning(f"Invalid classification for id {item_id}: {errors}")
+            continue
+        results[item_id] = normalize_skills(element)
+
+    logger.info(f"Batch returned {len(results)}/{len(items)} valid classifications.")
+    return results
+
+
+def classify_job_descriptions(job_descriptions: list[str],
+                              batch_size: int = 10,
+                              max_retries: int = 3,
+                              cache=None,
+                              executor: LLMExecutor = None,
+                              use_rules: bool = use_rules) -> list:
+    """
+    Classifies many job descriptions sending batch_size of them per Gemini call,
+    so the criteria block is sent once per batch instead of once per description.
+    Batches run in parallel through the executor. Descriptions that come back
+    missing or invalid are retried alone with classify_job_description.
+
+    With use_rules, the fields the rule engine fills with enough confidence are not
+    asked to the LLM. Descriptions that need the same remaining fields are batched
+    together with a prompt that only has those criteria.
+
+    Args:
+        job_descriptions (list[str]): The job descriptions to classify.
+        batch_size (int): Number of descriptions sent in each prompt.
+        max_retries (int): Maximum number of attempts for each retried description.
+        cache (ClassificationCache): Optional cache checked before calling the API,
+            successful results are written back to it.
+        executor (LLMExecutor): Client used for the API calls, the shared one by default.
+        use_rules (bool): Fill the high confidence fields with rules_functions first.
+
+    Returns:
+        list: The classifications in the same order as job_descriptions, None for
+        the ones that could not be classified.
+    """
+    executor = executor or get_executor()
+    results = [None] * len(job_descriptions)
+
+    # Descriptions already in the cache don't need an API call
+    pending = []
+    for i, job_description in enumerate(job_descriptions):
+        cached = cache.get(job_description) if cache is not None else None
+        if cached is not None:
+            results[i] = cached
+        else:
+            pending.append(i)
+    logger.info(f"{len(job_descriptions) - len(pending)} classifications found in cache, {len(pending)} to classify.")
+
+    # Fields filled by the rules, and the keys left for the LLM for each description
+    rule_values = dict(zip(pending, confident_fields([job_descriptions[i] for i in pending]))) if use_rules and pending else {}
+    keys_by_item = {i: [key for key in EXPECTED_KEYS if key not in rule_values.get(i, {})] for i in pending}
+    if rule_values:
+        filled = sum(len(EXPECTED_KEYS) - len(keys) for keys in keys_by_item.values())
+        logger.info(f"Rules filled {filled}/{len(pending) * len(EXPECTED_KEYS)} fields.")
+
+    def run_batch(task: tuple[tuple, list[int]]) -> list:
+        keys, batch = list(task[0]), task[1]
+        batch_results = classify_batch([(str(i), job_descriptions[i]) for i in batch], executor=executor, keys=keys)
+        classifications = []
+        for i in batch:
+            classification = batch_results.get(str(i))
+            if classification is None:
+                # Only the failed items of the batch are retried one by one
+                logger.warning(f"Retrying job description {i} alone...")
+                classification = classify_job_description(job_descriptions[i],
+                                                          max_retries=max_retries,
+                                                          executor=executor,
+                                                          keys=keys)
+            classifications.append(classification)
+        return classifications
+
+    # Descriptions that need the same keys share a prompt
+    groups: dict[tuple, list[int]] = {}
+    for i in pending:
+        groups.setdefault(tuple(keys_by_item[i]), []).append(i)
+    tasks = [(keys, group[start:start + batch_size])
+             for keys, group in groups.items()
+             for start in range(0, len(group), batch_size)]
+
+    # The cache is only used from this thread, the workers just call the API
+    for (keys, batch), classifications in zip(tasks, executor.map(run_batch, tasks)):
+        for i, classification in zip(batch, classifications):
+            if classification is not None:
+                merged = {**rule_values.get(i, {}), **{key: classification[key] for key in keys}}
+                classification = {key: merged[key] for key in EXPECTED_KEYS}
+                if cache is not None:
+                    cache.put(job_descriptions[i], classification)
+            results[i] = classification
+
+    logger.info(f"Gemini API latency: {executor.latency_stats()}")
+    return results
@@ -1,13 +1,31 @@
-from bs4 import BeautifulSoup
+import time
+# Start of the process, what runs before the pipeline (imports, DB setup) is reported as startup
+STARTED = time.perf_counter()
+
+import logging
 from config import *
 from genai_functions import *
 import polars as pl
-import requests
-import time
-import random
+import argparse
 # from tqdm import tqdm
-from datetime import date
+from datetime import date, datetime, timedelta
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
 from db_functions import *
+from fetch_functions import get_fetcher, set_fetcher
+from archive_functions import HtmlArchive, ReplayFetcher, ArchiveMissError
+from cache_functions import ClassificationCache
+from checkpoint_functions import get_resume_checkpoint, save_checkpoint
+from parsing_functions import make_soup
+from dataset_functions import append_to_dataset
+from dedup_functions import NearDuplicateIndex
+from stage_functions import MISSING_DESCRIPTIONS
+from schema_functions import GENAI_SCHEMA_OVERRIDES
+from metrics_functions import metrics, setup_logging, write_run_metrics, profiled
+
+logger = logging.getLogger(__name__)
 
 
 def name_format(job_name):
@@ -22,26 +40,30 @@ def name_format(job_name):
     """
     return job_name.replace(' ', '%20')
 
-def get_data(url):
-    r = requests.get(url, headers={"headers": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"}, timeout=5)
+def get_data(url, page_type='job'):
+    r = get_fetcher().get(url)
 
-    return BeautifulSoup(r.content, 'html.parser')
+    with metrics.timer('parse'):
+        return make_soup(r.content, page_type)
 
-def get_jobcards_soup():
+def get_jobcards_soup(job_name, location, start=0):
     formatted_job_name = name_format(job_name)
-    url = f"https://linkedin.com/jobs/search?keywords={formatted_job_name}&location={location}&f_TPR=r{date_posted_in_seconds}"
-    return get_data(url)
+    formatted_location = name_format(location)
+    if start == 0:
+        url = f"https://linkedin.com/jobs/search?keywords={formatted_job_name}&location={formatted_location}&f_TPR=r{date_posted_in_seconds}"
+    else:
+        # Following pages come from the "see more jobs" endpoint, which returns only the job cards
+        url = f"https://www.linkedin.com/jobs-guest/jobs/api/seeMoreJobPostings/search?keywords={formatted_job_name}&location={formatted_location}&f_TPR=r{date_posted_in_seconds}&start={start}"
+    return get_data(url, 'jobcards')
 
-def get_list_of_jobcards(soup):
+def parse_jobcards(soup):
     # Parsing the job card info (title, company, location, date, job_url) from the beautiful soup object
-    joblist = []
     try:
         divs = soup.find_all('div', class_='base-search-card__info')
     except:
-        print("Empty page, no jobs found")
-        return joblist
-    
-    print('Looking for jobs...')
+        logger.info("Empty page, no jobs found")
+        return
+
     for item in divs:
         title = item.find('h3').text.strip()
         company = item.find('a', class_='hidden-nested-link')
@@ -55,7 +77,7 @@ def get_list_of_jobcards(soup):
         date_tag = item.find('time', class_='job-search-card__listdate')
         date = date_tag['datetime'] if date_tag else date_tag_new['datetime'] if date_tag_new else ''
         job_description = ''
-        job = {
+        yield {
             'title': title,
             'company': company.text.strip().replace('\n', ' ') if company else '',
             'location': location.text.strip() if location else '',
@@ -63,12 +85,139 @@ def get_list_of_jobcards(soup):
             'job_url': job_url,
             'job_description': job_description,
         }
+
+def get_list_of_jobcards(soup, known_urls=frozenset()):
+    # Job cards whose job_url is in known_urls were already scraped in a previous run and are skipped
+    logger.info('Looking for jobs...')
+    joblist = []
+    skipped = 0
+    for job in parse_jobcards(soup):
+        if job['job_url'] in known_urls:
+            skipped += 1
+            continue
         joblist.append(job)
 
-    print(f'Found {len(joblist)} jobs')
+    logger.info(f'Found {len(joblist)} new jobs, skipped {skipped} already known')
     
     return joblist
 
+def iter_jobcards(job_name, location, known_urls=frozenset(), max_pages=discovery_max_pages, start=0):
+    """
+    Walk the paginated search results and yield the new job cards as each page is parsed.
+
+    Args:
+        job_name (str): Job name to search.
+        location (str): Location to search in.
+        known_urls (set): job_urls already stored in the database, these are not yielded.
+        max_pages (int): Maximum number of result pages to fetch.
+        start (int): Offset of the first page, used to resume an unfinished run.
+
+    Yields:
+        dict: Job card info (title, company, location, date, job_url) plus the
+        'page_start' offset of the page it came from.
+    """
+    oldest_date = (date.today() - timedelta(days=date_posted_in_days)).isoformat()
+    seen_urls = set()
+    resuming = start > 0
+    logger.info(f'Looking for {job_name} jobs in {location}...')
+    for page in range(max_pages):
+        page_start = start
+        try:
+            cards = list(parse_jobcards(get_jobcards_soup(job_name, location, start)))
+        except ArchiveMissError as e:
+            logger.info(f'Page {page + 1} is not in the archive, end of replay: {e}')
+            return
+        if not cards:
+            logger.info(f'Page {page + 1} has no job cards, end of results')
+            return
+        start += len(cards)
+        metrics.incr('jobcards_found', len(cards))
+
+        new_cards = [job for job in cards
+                     if job['job_url'] not in known_urls
+                     and job['job_url'] not in seen_urls
+                     and (not job['date'] or job['date'] >= oldest_date)]
+        logger.info(f'{job_name} in {location}, page {page + 1}: {len(cards)} job cards, {len(new_cards)} new')
+
+        # A page with only known or out of window postings means the rest were already scraped.
+        # When resuming, the first page can be fully committed by the previous run, so it doesn't count.
+        if not new_cards and not (resuming and page == 0):
+            return
+
+        for job in new_cards:
+            seen_urls.add(job['job_url'])
+            job['page_start'] = page_start
+            yield job
+
+def query_key(job_name, location):
+    return f'{job_name}|{location}'
+
+def iter_jobcards_multi(queries, known_urls=frozenset(), starts=None, max_workers=discovery_max_workers):
+    """
+    Run several searches concurrently and yield their job cards as they arrive, each
+    job_url only once even if several searches return it. The searches share the
+    fetcher, so they also share its rate limit per host.
+
+    Args:
+        queries (list): (job_name, location) pairs to search.
+        known_urls (set): job_urls already stored in the database, these are not yielded.
+        starts (dict): First page offset of each search by query_key, used to resume.
+        max_workers (int): Maximum number of searches running at the same time.
+
+    Yields:
+        dict: Job card info plus 'search_query' (the query_key) and 'page_start'.
+    """
+    starts = starts or {}
+    # Bounded queue, searches wait while the rest of the pipeline catches up
+    jobcards_queue = queue.Queue(maxsize=100)
+    stop = threading.Event()
+    search_done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                jobcards_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def discover(job_name, location):
+        key = query_key(job_name, location)
+        try:
+            for job in iter_jobcards(job_name, location, known_urls, start=starts.get(key, 0)):
+                job['search_query'] = key
+                put(job)
+                if stop.is_set():
+                    return
+        except Exception as e:
+            logger.error(f'Error looking for {job_name} jobs in {location}: {e}')
+        finally:
+            put(search_done)
+
+    seen_urls = set()
+    duplicates = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for job_name, location in queries:
+                executor.submit(discover, job_name, location)
+
+            remaining = len(queries)
+            while remaining:
+                job = jobcards_queue.get()
+                if job is search_done:
+                    remaining -= 1
+                    continue
+                if job['job_url'] in seen_urls:
+                    duplicates += 1
+                    continue
+                seen_urls.add(job['job_url'])
+                yield job
+        finally:
+            # Also reached if the consumer stops early, so the searches don't block on a full queue
+            stop.set()
+
+    logger.info(f'Discovered {len(seen_urls)} jobs in {len(queries)} searches, {duplicates} duplicates skipped')
+
 def get_job_info(soup):
 
     job_info = {}
@@ -124,102 +273,258 @@ def get_job_info(soup):
                 job_info[criterion_name] = criterion_value
             else:
                 # Optional: Print a warning if the structure is unexpected within an item
-                print(f"Warning: Skipping item, couldn't find expected h3/span: {item.prettify()}")
+                logger.warning(f"Skipping item, couldn't find expected h3/span: {item.prettify()}")
 
     else:
-        print("Error: Could not find the 'ul' with class 'description__job-criteria-list'.")
+        logger.error("Could not find the 'ul' with class 'description__job-criteria-list'.")
 
 
     return job_info
 
-def enrich_job_list(joblist, keywords):
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+def parse_job_page(url, response):
+    with metrics.timer('parse'):
+        return get_job_info(make_soup(response.content, 'job'))
+
+def iter_enriched_jobs(jobcards, keywords, known_urls=frozenset(), chunk_size=enrich_chunk_size):
+    """
+    Enrich the job cards as they arrive, fetching each chunk of them concurrently.
+
+    Args:
+        jobcards (iterable): Job card dictionaries, can be a generator such as iter_jobcards.
+        keywords (list): List of keywords to filter job titles.
+        known_urls (set): job_urls already stored in the database, these are not fetched again.
+        chunk_size (int): Number of job cards fetched concurrently before yielding them.
+
+    Yields:
+        dict: Every job card, with the job information added when it was fetched.
+    """
+    for chunk in chunked(jobcards, chunk_size):
+        # Check if the job title contains any of the keywords
+        jobs_to_fetch = [job for job in chunk
+                         if job['job_url'] not in known_urls
+                         and any(keyword in job['title'].lower() for keyword in keywords)]
+
+        # Fetch additional job information concurrently, the fetcher handles the rate limit per host
+        results = get_fetcher().map(parse_job_page, [job['job_url'] for job in jobs_to_fetch])
+
+        for job, job_info in zip(jobs_to_fetch, results):
+            if isinstance(job_info, Exception):
+                logger.error(f'Error getting job description for {job["title"]} in {job["company"]}: {job_info}',
+                             extra={'job_url': job['job_url']})
+                metrics.incr('enrich_errors')
+                continue
+            logger.info(f'Got job description for {job["title"]} in {job["company"]}', extra={'job_url': job['job_url']})
+            job.update(job_info)
+            metrics.incr('jobs_enriched')
+
+        yield from chunk
+
+def enrich_job_list(joblist, keywords, known_urls=frozenset()):
     """
     Enrich the job list with additional information such as job description, salary, and contract type.
 
     Args:
         joblist (list): List of job dictionaries.
         keywords (list): List of keywords to filter job titles.
+        known_urls (set): job_urls already stored in the database, these are not fetched again.
 
     Returns:
         list: The enriched job list.
     """
-    print('Looking for job descriptions...')
-    for job in joblist:
-        # Check if the job title contains any of the keywords
-        if any(keyword in job['title'].lower() for keyword in keywords):
-            try:
-                print('-' * 30)
-                print(f'Getting job description for {job["title"]} in {job["company"]}')
-
-                time.sleep(random.randint(2, 5))
-
-                # Fetch additional job information
-                job_info = get_job_info(get_data(job['job_url']))
-                job.update(job_info)
-                print('Job description starts with:', job_info['job_description'][:10])
-
-            except Exception as e:
-                print(f'Error getting job description for {job["title"]} in {job["company"]}: {e}')
-    return joblist
+    logger.info('Looking for job descriptions...')
+    return list(iter_enriched_jobs(joblist, keywords, known_urls))
     
         
-if __name__ == "__main__":
+def classify_jobs(df, cache=None):
+    """
+    Classify the job descriptions in df (job_url, job_description) with the LLM.
 
-    # Obtiene el objeto soup que contiene las jobcards
-    soup = get_jobcards_soup()
+    Returns:
+        pl.DataFrame: job_url and the classification columns of the jobs that could be
+        classified, empty if none.
+    """
+    classifications = classify_job_descriptions(df['job_description'].to_list(),
+                                                batch_size=classification_batch_size,
+                                                cache=cache)
+    genai_list: list[dict] = []
+    for job_url, classification in zip(df['job_url'].to_list(), classifications):
+        if classification is None:
+            continue
+        genai_data: dict = {}
+        genai_data.update(classification)
+        genai_data.update({'job_url': job_url})
+        genai_list.append(genai_data)
+
+    # Without the override a batch with no skills at all is inferred as List(Null)
+    return pl.DataFrame(genai_list, schema_overrides=GENAI_SCHEMA_OVERRIDES)
+
+def classify_and_store(df, cache, store):
+    """
+    Classify the job descriptions in df (job_url, job_description) with the LLM and
+    insert the classifications into the GenAI table.
 
-    # Devuelve una lista de diccionarios con la información de las jobcards (title, company, location, date, job_url)
-    joblist = get_list_of_jobcards(soup)
-    
-    # Con la info de las jobcards va a la URL de cada una y obtiene detalles del trabajo
-    joblist_with_info = enrich_job_list(joblist, keywords)
+    Returns:
+        int: Number of jobs classified and inserted.
+    """
+    df_genai = classify_jobs(df, cache)
+    if df_genai.is_empty():
+        logger.info('No new jobs classified')
+        return 0
 
-    # Transform the job list into a DataFrame
-    df = pl.DataFrame(joblist_with_info)
+    # Insert the classifications into the DB
+    store.upsert(df_genai, 'genai_table', 'genai_data')
+    return len(df_genai)
 
-    # Show jobs with description
-    df = df.filter(pl.col('job_description') != '')
-    print(df)
-    print(f'Found {len(df)} jobs with description')
-        
-    # Get today's date
-    today = date.today()
-    print("Today's date:", today)
+def process_batch(batch, batch_number, cache, store, dedup_index):
+    """
+    Persist one micro-batch of enriched jobs: Parquet dataset, base table and GenAI table.
 
-    # Export the DataFrame to a Parquet file
-    try:
-        df.write_parquet(f"/opt/airflow/output/jobs_from_{date_posted_in_days}_days_{today}.parquet")
-        print('Exported to Parquet file')
+    Returns:
+        list[str]: job_urls inserted into the base table, the jobs with description.
+    """
+    # Transform the batch into a DataFrame, the search and page offset are only needed for the checkpoint
+    df = pl.DataFrame([{k: v for k, v in job.items() if k not in ('search_query', 'page_start')} for job in batch])
 
-    except Exception as e:
-        print(f'Error exporting to Parquet file: {e}')
+    # Keep jobs with description (not fetched or page without one), job cards without a posting date get a null date
+    df = (df.filter(~pl.col('job_description').is_in(MISSING_DESCRIPTIONS))
+            .with_columns(pl.col('date').replace('', None)))
+    logger.info(f'Batch {batch_number}: {len(df)} jobs with description')
+    if df.is_empty():
+        return []
 
-    # Insert base data into database
+    # Append the new jobs to the Parquet dataset partitioned by posting date
     try:
-        insert_into_db(df, 'base_table', '/opt/airflow/output/my_project.duckdb', 'base_data')
-        print(f'Inserted {len(df)} jobs into base data DB')
+        with metrics.timer('dataset_write'):
+            append_to_dataset(df, dataset_dir)
 
     except Exception as e:
-        print(f'Error inserting into database: {e}')
+        logger.error(f'Error exporting to Parquet dataset: {e}')
 
+    # Insert base data into database, the batch is committed here
+    store.upsert(df, 'base_table', 'base_data')
 
-    # Use LLM to classify jobs
-    try:
-        genai_list: list[dict] = []
-        for row in df.rows(named=True):
-            genai_data: dict = {}
-            genai_data.update(classify_job_description(row['job_description']))
-            genai_data.update({'job_url': row['job_url']})
-            genai_list.append(genai_data)
+    # Reposts of a job already seen are not classified again, they get the classification of the canonical posting
+    with metrics.timer('dedup'):
+        duplicates = dedup_index.assign(df)
 
-    except Exception as e:
-        print(f'Error classifying jobs: {e}')
+    # Use LLM to classify jobs, descriptions already classified with the same prompt and model come from the cache
+    df_to_classify = df.filter(~pl.col('job_url').is_in(list(duplicates))).select('job_url', 'job_description')
+    with metrics.timer('classify'):
+        classify_and_store(df_to_classify, cache, store)
+    dedup_index.copy_classifications(store)
+    metrics.incr('batches_committed')
+    return df['job_url'].to_list()
 
-    # Put data into Dataframe then insert to DB
-    df_genai = pl.DataFrame(genai_list)
-    try:
-        insert_into_db(df_genai, 'genai_table', '/opt/airflow/output/my_project.duckdb', 'genai_data')
-        print(f'Inserted {len(df_genai)} jobs into GenAI data DB')
+def run_pipeline(store, known_urls, full_refresh=False, profile=False):
+    """
+    One run of the pipeline on an open JobStore: discovery, enrichment, micro-batches and
+    the classification backlog. The store is left open, the caller closes it.
 
-    except Exception as e:
-        print(f'Error inserting GenAI data into database: {e}')
\ No newline at end of file
+    Args:
+        store (JobStore): Store of the run.
+        known_urls (set): job_urls already stored, updated with the jobs committed in this run.
+        full_refresh (bool): Don't resume from the checkpoint nor classify the backlog.
+        profile (bool): Profile the run with cProfile.
+
+    Returns:
+        str: Path of the run metrics JSON file.
+    """
+    run_id = datetime.now().strftime('%Y%m%dT%H%M%S')
+    store.write_stats.clear()
+    # Cada corrida escribe su propio segmento del archivo HTML, también en el worker
+    archive = getattr(get_fetcher(), 'archive', None)
+    if isinstance(archive, HtmlArchive):
+        archive.roll()
+
+    # Si la corrida anterior no terminó, continúa desde la última página con un batch guardado
+    checkpoint = None if full_refresh else get_resume_checkpoint()
+    if checkpoint:
+        logger.info(f"Resuming run from {checkpoint['run_started_at']} at offsets {checkpoint['discovery_starts']}")
+    else:
+        checkpoint = {'run_started_at': datetime.now().isoformat(), 'discovery_starts': {},
+                      'batches_committed': 0, 'jobs_committed': 0}
+    checkpoint['status'] = 'running'
+    save_checkpoint(checkpoint)
+
+    with profiled(profile, f'{metrics_dir}/{run_id}.prof'):
+        # Corre todas las búsquedas en paralelo y va entregando las jobcards nuevas sin repetir (title, company, location, date, job_url)
+        jobcards = iter_jobcards_multi(search_queries, known_urls, starts=checkpoint['discovery_starts'])
+
+        # Con la info de las jobcards va a la URL de cada una y obtiene detalles del trabajo, a medida que llegan
+        enriched_jobs = iter_enriched_jobs(jobcards, keywords, known_urls)
+
+        # Cada micro-batch se guarda en la DB y se clasifica apenas está listo, después se guarda el checkpoint
+        cache = ClassificationCache(db_file, classification_version(), model_version, conn=store.conn)
+        dedup_index = NearDuplicateIndex(store.conn)
+        for batch in chunked(enriched_jobs, pipeline_batch_size):
+            batch_number = checkpoint['batches_committed'] + 1
+            # If a batch fails the run stops here, the checkpoint stays 'running' so the next run resumes
+            committed_urls = process_batch(batch, batch_number, cache, store, dedup_index)
+            checkpoint['jobs_committed'] += len(committed_urls)
+            checkpoint['batches_committed'] = batch_number
+            for job in batch:
+                checkpoint['discovery_starts'][job['search_query']] = job['page_start']
+            # Only the stored jobs, the ones that failed or had no description are fetched again in the next run
+            known_urls.update(committed_urls)
+            save_checkpoint(checkpoint)
+
+        # Jobs left without classification by previous runs or failed calls are classified at the end
+        if not full_refresh:
+            dedup_index.copy_classifications(store)
+            df_to_classify = store.get_unclassified_jobs()
+            logger.info(f'{len(df_to_classify)} jobs left to classify')
+            for df_batch in df_to_classify.iter_slices(pipeline_batch_size):
+                classify_and_store(df_batch, cache, store)
+            dedup_index.copy_classifications(store)
+
+    logger.info(f'Classification cache stats: {cache.stats()}')
+    cache.close()
+    logger.info(f'DB writes: {store.summary()}')
+    logger.info(f'Distinct roles in DB: {dedup_index.count_distinct_roles()}')
+    metrics_path = write_run_metrics(store.conn, run_id)
+
+    checkpoint['status'] = 'finished'
+    save_checkpoint(checkpoint)
+    logger.info(f"Run finished: {checkpoint['jobs_committed']} jobs in {checkpoint['batches_committed']} batches",
+                extra={'run_id': run_id, 'metrics_path': metrics_path})
+    return metrics_path
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='Ignore the jobs already stored in the DB, scrape and classify everything again')
+    parser.add_argument('--replay', action='store_true',
+                        help='Read the pages from the raw HTML archive instead of the network')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the run with cProfile, the stats are saved next to the run metrics')
+    args = parser.parse_args()
+
+    # Logs en JSON a stdout, una línea por evento
+    setup_logging()
+
+    if args.replay:
+        set_fetcher(ReplayFetcher(HtmlArchive(archive_dir)))
+
+    # Una sola conexión a la DB para toda la corrida
+    store = JobStore(db_file)
+
+    # Carga las job_urls que ya están en la DB para no volver a scrapearlas ni clasificarlas
+    if args.full_refresh:
+        known_urls = set()
+    else:
+        known_urls, _ = store.get_known_job_urls()
+
+    # Costo fijo de cada proceso: imports, conexión a la DB y carga de las URLs conocidas
+    metrics.add_time('startup', time.perf_counter() - STARTED)
+    logger.info(f'Startup took {time.perf_counter() - STARTED:.2f} seconds')
+
+    metrics_path = run_pipeline(store, known_urls, args.full_refresh, args.profile)
+    store.close()
+    # Última línea de stdout, Airflow la guarda como XCom
+    print(metrics_path)
@@ -0,0 +1,156 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+from config import metrics_dir
+
+logger = logging.getLogger(__name__)
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each log record as one JSON line, fields passed in extra= are included."""
+
+    STANDARD_ATTRS = set(logging.LogRecord('', 0, '', 0, '', None, None).__dict__) | {'message'}
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update({k: v for k, v in record.__dict__.items() if k not in self.STANDARD_ATTRS})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(level: int = logging.INFO):
+    """Sends the logs of every module to stdout as JSON lines."""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+
+class Metrics:
+    """
+    Thread-safe counters and stage timers for one run.
+
+    Counters are plain sums (pages fetched, bytes, LLM calls, rows upserted...) and
+    timers accumulate the calls and total milliseconds spent in each stage.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = datetime.now()
+            self.counters = defaultdict(int)
+            self.timers = defaultdict(lambda: {'calls': 0, 'ms': 0.0})
+
+    def incr(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def add_time(self, stage: str, seconds: float):
+        with self.lock:
+            self.timers[stage]['calls'] += 1
+            self.timers[stage]['ms'] += seconds * 1000
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Times the block and adds it to the stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def merge(self, summary: dict):
+        """Adds the counters and timers of another summary, e.g. of a task that ran in another process."""
+        with self.lock:
+            self.started_at = min(self.started_at, datetime.fromisoformat(summary['started_at']))
+            for name, value in summary['counters'].items():
+                self.counters[name] += value
+            for stage, timer in summary['timers'].items():
+                self.timers[stage]['calls'] += timer['calls']
+                self.timers[stage]['ms'] += timer['ms']
+
+    def summary(self) -> dict:
+        with self.lock:
+            finished_at = datetime.now()
+            return {
+                'started_at': self.started_at.isoformat(),
+                'finished_at': finished_at.isoformat(),
+                'duration_s': (finished_at - self.started_at).total_seconds(),
+                'counters': dict(self.counters),
+                'timers': {stage: dict(timer) for stage, timer in self.timers.items()},
+            }
+
+
+# Shared by every module of the pipeline
+metrics = Metrics()
+
+
+def write_run_metrics(conn, run_id: str, directory: str = metrics_dir) -> str:
+    """
+    Saves the run summary as a row of the run_metrics table and as a JSON file.
+
+    Returns:
+        str: Path of the JSON file, also copied to latest.json in the same directory.
+    """
+    summary = dict(metrics.summary(), run_id=run_id)
+    conn.execute("""CREATE TABLE IF NOT EXISTS run_metrics(
+                    run_id VARCHAR PRIMARY KEY,
+                    started_at TIMESTAMP,
+                    finished_at TIMESTAMP,
+                    duration_s DOUBLE,
+                    counters JSON,
+                    timers JSON
+                    );
+                    """)
+    conn.execute("INSERT OR REPLACE INTO run_metrics VALUES (?, ?, ?, ?, ?, ?)",
+                 [run_id, summary['started_at'], summary['finished_at'], summary['duration_s'],
+                  json.dumps(summary['counters']), json.dumps(summary['timers'])])
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{run_id}.json")
+    for file_path in (path, os.path.join(directory, 'latest.json')):
+        with open(file_path, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return path
+
+
+@contextmanager
+def profiled(enabled: bool, output_path: str, top: int = 30):
+    """
+    Profiles the block with cProfile when enabled, saving the stats to output_path
+    (open with snakeviz or pstats) and logging the top functions by cumulative time.
+    """
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        profiler.dump_stats(output_path)
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+        logger.info(f"Profile saved to {output_path}\n{stream.getvalue()}")
@@ -0,0 +1,39 @@
+import re
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+from config import html_parser_backend
+
+# Only the parts of each page that get_list_of_jobcards/parse_jobcards and get_job_info read.
+# The job card div is the parent of 'base-search-card__info' and holds the data-entity-urn.
+STRAINERS = {
+    'jobcards': SoupStrainer(attrs={'data-entity-urn': True}),
+    # Matched with a regex because a list of classes doesn't match multi-class elements on bs4 >= 4.13
+    'job': SoupStrainer(class_=re.compile(r'(^|\s)(description__text|description__job-criteria-list)(\s|$)')),
+}
+
+# Backend name -> (BeautifulSoup parser, whether to build only the strained parts of the page)
+PARSER_BACKENDS = {
+    'html.parser': ('html.parser', False),
+    'html.parser-strained': ('html.parser', True),
+    'lxml': ('lxml', False),
+    'lxml-strained': ('lxml', True),
+}
+
+
+def make_soup(content, page_type: str, backend: str = html_parser_backend) -> BeautifulSoup:
+    """
+    Parses a page with the chosen backend.
+
+    Args:
+        content (bytes | str): The HTML of the page.
+        page_type (str): 'jobcards' for search result pages, 'job' for job detail pages.
+        backend (str): One of PARSER_BACKENDS.
+
+    Returns:
+        BeautifulSoup: The parsed page. With a strained backend only the elements
+        read by the parsing functions are in the tree.
+    """
+    parser, strained = PARSER_BACKENDS[backend]
+    parse_only = STRAINERS[page_type] if strained else None
+    return BeautifulSoup(content, parser, parse_only=parse_only)
@@ -0,0 +1,201 @@
+import argparse
+
+import duckdb
+import polars as pl
+
+from config import db_file, rules_confidence_threshold
+
+# Bump this whenever the patterns or the confidences change, it invalidates the cached classifications
+RULES_VERSION = "2"
+
+# Fields the rules can fill, the rest (task_clarity, seniority_level_ai, requires_degree_it) always go to the LLM
+RULE_FIELDS = [
+    "years_of_experience",
+    "cloud_preference",
+    "is_in_english",
+    "mentions_certifications",
+    "skills_mentioned",
+]
+
+# Patterns over the lowercased description for each skill in genai_functions.SKILLS_WANTED
+SKILL_PATTERNS = {
+    "Databricks or snowflake": r"databricks|snowflake",
+    "Develop pipelines or ETL/ELT processes": r"pipeline|\betl\b|\belt\b|ingesta|ingestion",
+    "Data modeling": r"data model|modelado de datos|modelamiento de datos|modelos de datos|dimensional|star schema|data vault",
+    "Data analysis or visualization": r"power ?bi|tableau|looker|visuali[sz]a|dashboard|an[aá]lisis de datos|data analysis",
+    "Data quality": r"data quality|calidad de (los )?datos",
+    "Data governance": r"governance|gobierno de datos|gobernanza",
+    "Knowledge of Machine Learning or MLOps": r"machine learning|mlops|\bml\b|aprendizaje autom[aá]tico",
+    "CI/CD": r"ci/cd|\bci ?cd\b|continuous integration|integraci[oó]n continua|jenkins|github actions|gitlab ci",
+    "Collaboration with data scientists or analysts": r"data scientists?|cient[ií]ficos? de datos|analistas|analysts",
+    "Automation/Orchestration (Airflow, Prefect, Dagster, etc.)": r"airflow|prefect|dagster|luigi|orquestaci|orchestrat",
+    "Data monitoring": r"data monitoring|monitoreo de datos|observabilidad|observability|\bmonitor(?:ing|eo|ear)\b[^.]{0,40}\b(?:datos|data|pipelines?|jobs?|procesos)\b",
+    "Migration": r"\bmigra(?:tions?|tes?|ting|ci[oó]n|ciones|r)\b",
+    "Version control (GIT or similar)": r"\bgit\b|github|gitlab|bitbucket|control de versiones|version control",
+    "APIs": r"\bapis?\b|\brest(ful)?\b",
+    "Spark knowledge": r"spark",
+}
+
+# Number followed by years, e.g. "3 years", "5+ años", "2-4 years"
+YEARS_PATTERN = r"\b\d{1,2}\s*\+?\s*(?:(?:-|a|to)\s*\d{1,2}\s*\+?\s*)?(?:years?|a[ñn]os)\b"
+
+# Certifications said not to be needed, e.g. "Certificación AWS (no es necesaria)"
+CERTIFICATION_NOT_NEEDED = (r"certifica\w*[^.]{0,60}(?:no es necesari|no son necesari|no se requiere|no requerid|not required|not necessary)"
+                            r"|(?:no se requiere|no es necesari\w*|not required)[^.]{0,30}certifica")
+
+# Highest confidence of the fields whose rules have not been checked against the LLM yet, below
+# rules_confidence_threshold so the LLM still classifies them. Raise it for a field once
+# agreement_report shows the rules agree with the LLM on it.
+UNVALIDATED_MAX_CONFIDENCE = 0.7
+
+ENGLISH_WORDS = r"\b(?:the|and|with|you|will|our|we|for|of|to)\b"
+SPANISH_WORDS = r"\b(?:el|la|los|las|y|con|para|del|que|nuestro|experiencia)\b"
+
+
+def preclassify(descriptions: pl.Series) -> pl.DataFrame:
+    """
+    Fills the RULE_FIELDS of every description at once with regexes over the column.
+
+    Args:
+        descriptions (pl.Series): The job descriptions.
+
+    Returns:
+        pl.DataFrame: One row per description with a column per field in RULE_FIELDS,
+        using the same allowed values as the LLM, and a '<field>_confidence' column
+        between 0 and 1.
+    """
+    text = pl.col("job_description").str.to_lowercase()
+
+    # Years of experience: the minimum number found, confident only if there is a single one
+    years = (text.str.extract_all(YEARS_PATTERN)
+             .list.eval(pl.element().str.extract(r"(\d{1,2})", 1).cast(pl.Int32))
+             .list.eval(pl.element().filter(pl.element() <= 15)))
+    min_years = years.list.min()
+    years_value = (pl.when(min_years.is_null()).then(pl.lit("Not Specified"))
+                   .when(min_years >= 7).then(pl.lit("7+"))
+                   .otherwise(min_years.cast(pl.Utf8)))
+    years_confidence = (pl.when(min_years.is_null()).then(0.6)
+                        .when(years.list.unique().list.len() == 1).then(0.9)
+                        .otherwise(0.6))
+
+    # Cloud preference
+    aws = text.str.contains(r"\baws\b|amazon web services|redshift")
+    azure = text.str.contains(r"\bazure\b|synapse|data factory")
+    gcp = text.str.contains(r"\bgcp\b|google cloud|bigquery")
+    other_cloud = text.str.contains(r"oracle cloud|\boci\b|ibm cloud|alibaba cloud|digitalocean")
+    any_cloud = text.str.contains(r"\bcloud\b|\bnube\b")
+    n_clouds = aws.cast(pl.Int8) + azure.cast(pl.Int8) + gcp.cast(pl.Int8)
+    cloud_value = (pl.when(n_clouds > 1).then(pl.lit("Multiple Clouds"))
+                   .when(aws).then(pl.lit("AWS"))
+                   .when(azure).then(pl.lit("Azure"))
+                   .when(gcp).then(pl.lit("GCP"))
+                   .when(other_cloud).then(pl.lit("Other Cloud"))
+                   .when(any_cloud).then(pl.lit("No Preference"))
+                   .otherwise(pl.lit("No Mention")))
+    # Several clouds may still have a main one, and a generic "cloud" is ambiguous
+    cloud_confidence = (pl.when(n_clouds > 1).then(0.5)
+                        .when(n_clouds == 1).then(0.9)
+                        .when(other_cloud).then(0.8)
+                        .when(any_cloud).then(0.6)
+                        .otherwise(0.9))
+
+    # Language: explicit mention of English, otherwise English vs Spanish stopwords
+    english_words = text.str.count_matches(ENGLISH_WORDS)
+    spanish_words = text.str.count_matches(SPANISH_WORDS)
+    mentions_english = text.str.contains(r"english|ingl[eé]s")
+    english_value = (pl.when(mentions_english | (english_words > spanish_words))
+                     .then(pl.lit("Yes")).otherwise(pl.lit("No")))
+    english_confidence = (pl.when(mentions_english).then(0.9)
+                          .when((english_words > 2 * spanish_words) | (spanish_words > 2 * english_words)).then(0.9)
+                          .otherwise(0.5))
+
+    # Certifications: a mention that says they're not needed is a "No", and a single mention
+    # may be something else (e.g. "certificado de antecedentes")
+    certification_mentions = text.str.count_matches(r"certifica|certified")
+    certification_not_needed = text.str.contains(CERTIFICATION_NOT_NEEDED)
+    certification_value = (pl.when((certification_mentions > 0) & ~certification_not_needed)
+                           .then(pl.lit("Yes")).otherwise(pl.lit("No")))
+    certification_confidence = (pl.when(certification_not_needed).then(0.5)
+                                .when(certification_mentions >= 2).then(0.8)
+                                .when(certification_mentions == 1).then(0.6)
+                                .otherwise(0.8))
+
+    # Skills: every pattern found, no skills is an empty list. A skill mentioned more than once is
+    # more certain than a single (maybe incidental) match, and the LLM can also add "strongly
+    # implied" skills, so a description without matches is only half certain.
+    skill_mentions = [text.str.count_matches(pattern) for pattern in SKILL_PATTERNS.values()]
+    skills_value = pl.concat_list([
+        pl.when(mentions > 0).then(pl.lit(skill)).otherwise(pl.lit(None, dtype=pl.Utf8))
+        for skill, mentions in zip(SKILL_PATTERNS, skill_mentions)
+    ]).list.drop_nulls()
+    skills_found = pl.sum_horizontal([(mentions > 0).cast(pl.Int32) for mentions in skill_mentions])
+    skills_repeated = pl.sum_horizontal([(mentions > 1).cast(pl.Int32) for mentions in skill_mentions])
+    skills_confidence = (pl.when(skills_found == 0).then(0.5)
+                         .otherwise(0.5 + 0.5 * skills_repeated / skills_found))
+
+    return pl.DataFrame({"job_description": descriptions}).select(
+        years_value.alias("years_of_experience"),
+        years_confidence.alias("years_of_experience_confidence"),
+        cloud_value.alias("cloud_preference"),
+        cloud_confidence.alias("cloud_preference_confidence"),
+        english_value.alias("is_in_english"),
+        english_confidence.alias("is_in_english_confidence"),
+        certification_value.alias("mentions_certifications"),
+        pl.min_horizontal(certification_confidence, UNVALIDATED_MAX_CONFIDENCE).alias("mentions_certifications_confidence"),
+        skills_value.alias("skills_mentioned"),
+        pl.min_horizontal(skills_confidence, UNVALIDATED_MAX_CONFIDENCE).alias("skills_mentioned_confidence"),
+    )
+
+
+def confident_fields(descriptions: list[str], threshold: float = rules_confidence_threshold) -> list[dict]:
+    """
+    Returns, for each description, the rule values whose confidence reaches the threshold.
+    The LLM only needs to be asked for the other fields.
+    """
+    df = preclassify(pl.Series("job_description", descriptions, dtype=pl.Utf8))
+    return [{field: row[field] for field in RULE_FIELDS if row[f"{field}_confidence"] >= threshold}
+            for row in df.rows(named=True)]
+
+
+def agreement_report(conn, threshold: float = rules_confidence_threshold) -> pl.DataFrame:
+    """
+    Compares the rules with the LLM classifications already stored in genai_table.
+
+    Returns:
+        pl.DataFrame: For each field, the share of rows where the rules are confident,
+        and how often they agree with the LLM overall and on the confident rows.
+        Skills agree when both lists have the same skills.
+    """
+    df = conn.execute("""SELECT b.job_description, g.*
+                         FROM base_table b JOIN genai_readable g ON b.job_url = g.job_url""").pl()
+    if df.is_empty():
+        return pl.DataFrame()
+    rules = preclassify(df["job_description"])
+
+    report = []
+    for field in RULE_FIELDS:
+        if field == "skills_mentioned":
+            agree = rules[field].list.sort() == df[field].list.sort()
+        else:
+            agree = rules[field] == df[field]
+        confident = rules[f"{field}_confidence"] >= threshold
+        report.append({
+            "field": field,
+            "rows": len(df),
+            "confident_share": confident.mean(),
+            "agreement": agree.mean(),
+            "agreement_when_confident": agree.filter(confident).mean(),
+        })
+    return pl.DataFrame(report)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Reports how often the rules agree with the LLM classifications')
+    parser.add_argument('--threshold', type=float, default=rules_confidence_threshold)
+    args = parser.parse_args()
+
+    conn = duckdb.connect(database=db_file, read_only=True)
+    with pl.Config(tbl_rows=-1):
+        print(agreement_report(conn, args.threshold))
+    conn.close()
@@ -0,0 +1,187 @@
+import argparse
+import logging
+
+import polars as pl
+
+from config import db_file
+from genai_functions import ALLOWED_VALUES, NO_SKILLS, SKILLS_WANTED
+
+logger = logging.getLogger(__name__)
+
+# DuckDB ENUM type of each categorical column of genai_table, built from the allowed values
+ENUM_TYPES = {key: f"{key}_enum" for key in ALLOWED_VALUES}
+
+# Bit of each skill in skills_mask. New skills must be appended to SKILLS_WANTED so the stored masks stay valid.
+SKILL_BITS = {skill: 1 << i for i, skill in enumerate(SKILLS_WANTED)}
+
+# Dtypes of the classification frames built from dicts that Polars can't infer on every batch
+GENAI_SCHEMA_OVERRIDES = {'skills_mentioned': pl.List(pl.Utf8)}
+
+GENAI_TABLE_V2_SQL = """CREATE TABLE IF NOT EXISTS {table_name}(
+                        job_url VARCHAR PRIMARY KEY,
+                        task_clarity task_clarity_enum,
+                        seniority_level_ai seniority_level_ai_enum,
+                        requires_degree_it requires_degree_it_enum,
+                        mentions_certifications mentions_certifications_enum,
+                        years_of_experience years_of_experience_enum,
+                        is_in_english is_in_english_enum,
+                        cloud_preference cloud_preference_enum,
+                        skills_mask UINTEGER
+                        );
+                        """
+
+# genai_table with the readable columns of the v1 schema
+GENAI_READABLE_VIEW_SQL = """CREATE OR REPLACE VIEW genai_readable AS
+                             SELECT job_url,
+                                    task_clarity::VARCHAR AS task_clarity,
+                                    seniority_level_ai::VARCHAR AS seniority_level_ai,
+                                    requires_degree_it::VARCHAR AS requires_degree_it,
+                                    mentions_certifications::VARCHAR AS mentions_certifications,
+                                    years_of_experience::VARCHAR AS years_of_experience,
+                                    is_in_english::VARCHAR AS is_in_english,
+                                    cloud_preference::VARCHAR AS cloud_preference,
+                                    decode_skills(skills_mask) AS skills_mentioned
+                             FROM genai_table;
+                             """
+
+
+def sql_list(values: list[str]) -> str:
+    return ', '.join("'" + value.replace("'", "''") + "'" for value in values)
+
+
+def create_types(conn):
+    """Creates the ENUM types and the decode_skills(mask) SQL macro."""
+    for key, type_name in ENUM_TYPES.items():
+        conn.execute(f"CREATE TYPE IF NOT EXISTS {type_name} AS ENUM ({sql_list(ALLOWED_VALUES[key])})")
+    conn.execute(f"""CREATE OR REPLACE MACRO decode_skills(mask) AS
+                     CASE WHEN mask IS NULL THEN NULL
+                          ELSE list_filter([{sql_list(SKILLS_WANTED)}], (skill, i) -> (mask >> (i - 1)) & 1 = 1)
+                     END""")
+
+
+def create_readable_view(conn):
+    conn.execute(GENAI_READABLE_VIEW_SQL)
+
+
+def encode_skills(skills: list[str]) -> int:
+    """Bitmask of a list of skills over SKILLS_WANTED."""
+    unknown = [skill for skill in skills if skill not in SKILL_BITS]
+    if unknown:
+        raise ValueError(f"Unknown skills: {unknown}")
+    return sum(SKILL_BITS[skill] for skill in set(skills))
+
+
+def decode_skills(mask: int) -> list[str]:
+    """Skills of a bitmask, in SKILLS_WANTED order."""
+    return [skill for skill, bit in SKILL_BITS.items() if mask & bit]
+
+
+def encode_genai(df: pl.DataFrame) -> pl.DataFrame:
+    """
+    Converts classification rows to the v2 columns: skills_mentioned becomes skills_mask.
+
+    Raises:
+        ValueError: If a categorical value or a skill is not one of the allowed ones.
+            DuckDB would also reject them when casting to the ENUM types, but without
+            saying which column failed.
+    """
+    for key, values in ALLOWED_VALUES.items():
+        if key in df.columns:
+            invalid = df.filter(pl.col(key).is_not_null() & ~pl.col(key).cast(pl.Utf8).is_in(values))[key].unique().to_list()
+            if invalid:
+                raise ValueError(f"Values not allowed in {key}: {invalid}")
+
+    if 'skills_mentioned' not in df.columns:
+        return df
+    # A batch where every job has no skills is inferred as List(Null), which the list operations reject
+    df = df.with_columns(pl.col('skills_mentioned').cast(GENAI_SCHEMA_OVERRIDES['skills_mentioned']))
+    # No skills is an empty mask, not the NO_SKILLS bit
+    bits = pl.col('skills_mentioned').list.set_difference([NO_SKILLS]).list.eval(pl.element().replace_strict(SKILL_BITS, default=0, return_dtype=pl.UInt32))
+    unknown = df.filter(bits.list.contains(0))['skills_mentioned'].explode().unique().to_list()
+    unknown = [skill for skill in unknown if skill not in SKILL_BITS]
+    if unknown:
+        raise ValueError(f"Unknown skills: {unknown}")
+    return df.with_columns(bits.list.unique().list.sum().cast(pl.UInt32).alias('skills_mask')).drop('skills_mentioned')
+
+
+def decode_genai(df: pl.DataFrame) -> pl.DataFrame:
+    """Inverse of encode_genai: ENUM columns as strings and skills_mask as the skills_mentioned list."""
+    df = df.with_columns(pl.col(key).cast(pl.Utf8) for key in ALLOWED_VALUES if key in df.columns)
+    if 'skills_mask' not in df.columns:
+        return df
+    return df.with_columns(
+        pl.col('skills_mask').map_elements(decode_skills, return_dtype=pl.List(pl.Utf8)).alias('skills_mentioned')
+    ).drop('skills_mask')
+
+
+def clear_no_skills(conn) -> int:
+    """
+    Clears the NO_SKILLS bit of the stored rows, written before no skills became an empty
+    mask. Runs in the caller's transaction.
+
+    Returns:
+        int: Number of rows changed.
+    """
+    bit = SKILL_BITS[NO_SKILLS]
+    return conn.execute(f"UPDATE genai_table SET skills_mask = skills_mask & ~{bit}::UINTEGER WHERE skills_mask & {bit} <> 0").fetchone()[0]
+
+
+def is_v1(conn, table_name: str = 'genai_table') -> bool:
+    """True if the table still has the v1 schema (VARCHAR columns and skills_mentioned list)."""
+    columns = {row[0] for row in conn.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = ?", [table_name]).fetchall()}
+    return 'skills_mentioned' in columns
+
+
+def migrate_genai_table(conn, drop_v1: bool = False) -> int:
+    """
+    Moves genai_table from the v1 schema to ENUM columns and skills_mask. Values outside
+    the allowed sets (classifications from before the validation) become NULL and are
+    logged. The v1 table is kept as genai_table_v1 unless drop_v1.
+
+    Returns:
+        int: Number of rows migrated.
+    """
+    create_types(conn)
+    conn.begin()
+    try:
+        conn.execute("ALTER TABLE genai_table RENAME TO genai_table_v1")
+        conn.execute(GENAI_TABLE_V2_SQL.format(table_name='genai_table'))
+        casts = ', '.join(f"TRY_CAST({key} AS {type_name})" for key, type_name in ENUM_TYPES.items())
+        skill_bits = ' + '.join(f"(CASE WHEN list_contains(skills_mentioned, '{skill.replace(chr(39), chr(39) * 2)}') THEN {bit} ELSE 0 END)"
+                                for skill, bit in SKILL_BITS.items())
+        conn.execute(f"""INSERT INTO genai_table (job_url, {', '.join(ENUM_TYPES)}, skills_mask)
+                         SELECT job_url, {casts},
+                                CASE WHEN skills_mentioned IS NULL THEN NULL ELSE ({skill_bits})::UINTEGER END
+                         FROM genai_table_v1""")
+        invalid = {key: conn.execute(f"SELECT count(*) FROM genai_table_v1 WHERE {key} IS NOT NULL AND TRY_CAST({key} AS {type_name}) IS NULL").fetchone()[0]
+                   for key, type_name in ENUM_TYPES.items()}
+        migrated = conn.execute("SELECT count(*) FROM genai_table").fetchone()[0]
+        if drop_v1:
+            conn.execute("DROP TABLE genai_table_v1")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    logger.info(f"Migrated {migrated} rows of genai_table to the v2 schema, values set to NULL per column: {invalid}")
+    if drop_v1:
+        # Gives the space of the v1 table back
+        conn.execute("CHECKPOINT")
+    return migrated
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Migrates genai_table to the v2 schema (ENUM columns and skills bitmask)')
+    parser.add_argument('--drop-v1', action='store_true', help='Drop the v1 table after migrating instead of keeping it as genai_table_v1')
+    args = parser.parse_args()
+
+    import duckdb
+    conn = duckdb.connect(database=db_file, read_only=False)
+    if is_v1(conn):
+        migrate_genai_table(conn, args.drop_v1)
+    elif args.drop_v1:
+        conn.execute("DROP TABLE IF EXISTS genai_table_v1")
+        conn.execute("CHECKPOINT")
+    conn.close()
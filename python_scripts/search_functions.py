@@ -0,0 +1,294 @@
+import argparse
+import logging
+import re
+import time
+
+import polars as pl
+
+from config import db_file, search_bm25_k1, search_bm25_b
+
+logger = logging.getLogger(__name__)
+
+# Words too common to be worth a postings list. Their positions still count, so the phrase
+# "ingeniero de datos" matches "ingeniero de datos" but not "ingeniero datos". 'it' is not
+# one of them, in the Spanish postings it's the IT department.
+STOPWORDS = [
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is', 'of', 'on', 'or',
+    'our', 'that', 'the', 'this', 'to', 'we', 'will', 'with', 'you', 'your',
+    'al', 'como', 'con', 'de', 'del', 'el', 'en', 'es', 'la', 'las', 'lo', 'los', 'para', 'por',
+    'que', 'se', 'su', 'sus', 'un', 'una', 'y',
+]
+
+# Lowercase, accent-folded words. + and # are kept for c++, c#, 5+ (years), ...
+TOKENS_MACRO_SQL = """CREATE OR REPLACE MACRO search_tokens(text) AS
+                      regexp_split_to_array(strip_accents(lower(coalesce(text, ''))), '[^a-z0-9+#]+')
+                      """
+
+# Query syntax: words and "quoted phrases" must all match, OR between two of them matches
+# either, a leading - (or NOT) excludes the postings that match
+QUERY_TOKEN_PATTERN = re.compile(r'(-?)"([^"]*)"|(\S+)')
+
+
+class SearchIndex:
+    """
+    Inverted index over the job descriptions of base_table, ranked with BM25.
+
+    search_docs has one row per posting (token count, date and company for the filters) and
+    search_postings one row per (term, posting) with the positions of the term, used by the
+    phrase queries. JobStore keeps both up to date inside each base_table upsert transaction:
+    the postings of the upserted job_urls are deleted and indexed again from the stored rows.
+
+    Args:
+        conn (duckdb.DuckDBPyConnection): Connection to the project database, base_table must exist.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.execute(TOKENS_MACRO_SQL)
+        existing = {row[0] for row in self.conn.execute("SELECT table_name FROM duckdb_tables()").fetchall()}
+        self.conn.execute("CREATE SEQUENCE IF NOT EXISTS search_doc_id_seq")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS search_docs(
+                             doc_id INTEGER PRIMARY KEY,
+                             job_url VARCHAR UNIQUE,
+                             length INTEGER,
+                             date DATE,
+                             company VARCHAR
+                             );
+                             """)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS search_postings(
+                             term VARCHAR,
+                             doc_id INTEGER,
+                             tf INTEGER,
+                             positions INTEGER[]
+                             );
+                             """)
+        # An index added to a database that already has postings starts from a full build
+        if not existing.issuperset({'search_docs', 'search_postings'}):
+            self.rebuild()
+
+    def _index(self, changed: str):
+        """Indexes the base_table rows that match the changed filter."""
+        self.conn.execute(f"""INSERT INTO search_docs
+                              SELECT nextval('search_doc_id_seq'), job_url,
+                                     len(list_filter(search_tokens(job_description), t -> t <> '')),
+                                     date, coalesce(company, '')
+                              FROM base_table WHERE {changed}
+                              """)
+        self.conn.execute(f"""INSERT INTO search_postings
+                              SELECT term, doc_id, count(*), list(position ORDER BY position)
+                              FROM (SELECT d.doc_id, unnest(tokens) AS term, generate_subscripts(tokens, 1) AS position
+                                    FROM (SELECT job_url, search_tokens(job_description) AS tokens FROM base_table WHERE {changed}) b
+                                    JOIN search_docs d ON d.job_url = b.job_url)
+                              WHERE term <> '' AND NOT list_contains($stopwords, term)
+                              GROUP BY term, doc_id
+                              """, {'stopwords': STOPWORDS})
+
+    def apply(self, changed_relation: str):
+        """
+        Indexes again the postings whose job_url is in changed_relation, after they were
+        upserted into base_table. Runs in the caller's transaction.
+        """
+        changed = f"job_url IN (SELECT job_url FROM {changed_relation})"
+        self.conn.execute(f"DELETE FROM search_postings WHERE doc_id IN (SELECT doc_id FROM search_docs WHERE {changed})")
+        self.conn.execute(f"DELETE FROM search_docs WHERE {changed}")
+        self._index(changed)
+
+    def rebuild(self):
+        """Indexes all of base_table from scratch."""
+        self.conn.execute("DELETE FROM search_postings")
+        self.conn.execute("DELETE FROM search_docs")
+        self._index('TRUE')
+        docs = self.conn.execute("SELECT count(*) FROM search_docs").fetchone()[0]
+        logger.info(f"Indexed {docs} job descriptions for search")
+        self.optimize()
+
+    def optimize(self):
+        """
+        Rewrites search_postings sorted by term. The postings of the upserts are appended
+        at the end, sorting them again lets the term lookups skip most of the table.
+        """
+        start = time.perf_counter()
+        self.conn.execute("CREATE OR REPLACE TEMP TABLE search_postings_sorted AS SELECT * FROM search_postings ORDER BY term, doc_id")
+        self.conn.execute("DELETE FROM search_postings")
+        self.conn.execute("INSERT INTO search_postings SELECT * FROM search_postings_sorted")
+        self.conn.execute("DROP TABLE search_postings_sorted")
+        logger.info(f"Sorted search_postings in {time.perf_counter() - start:.1f} seconds")
+
+    def tokenize(self, texts: list[str]) -> list[list[tuple[str, int]]]:
+        """
+        Terms of each text with their offset from the first one, as the descriptions are
+        indexed. Stopwords are dropped but keep their place.
+        """
+        tokens_list = self.conn.execute("SELECT list_transform($1::VARCHAR[], t -> search_tokens(t))", [texts]).fetchone()[0]
+        terms_list = []
+        for tokens in tokens_list:
+            positions = [(token, i) for i, token in enumerate(tokens) if token and token not in STOPWORDS]
+            terms_list.append([(token, i - positions[0][1]) for token, i in positions])
+        return terms_list
+
+    def parse_query(self, query: str) -> tuple[list[list[list]], list[list]]:
+        """
+        Parses a query into the groups that must all match (each one a list of
+        alternatives joined by OR) and the excluded items. An item is a word or a phrase,
+        as its list of (term, offset).
+
+        Raises:
+            ValueError: If nothing in the query can be searched for.
+        """
+        raw_items = []  # (text, negated, joined to the previous item by OR)
+        join_or = False
+        for match in QUERY_TOKEN_PATTERN.finditer(query):
+            negated_phrase, phrase, word = match.groups()
+            if word == 'OR':
+                join_or = bool(raw_items)
+                continue
+            if word == 'AND':
+                continue
+            if phrase is not None:
+                raw_items.append((phrase, bool(negated_phrase), join_or))
+            elif word.startswith('-') and len(word) > 1:
+                raw_items.append((word[1:], True, False))
+            else:
+                raw_items.append((word, False, join_or))
+            join_or = False
+
+        # NOT applies to the item after it
+        items, negate_next = [], False
+        for text, negated, joined in raw_items:
+            if text == 'NOT':
+                negate_next = True
+                continue
+            items.append((text, negated or negate_next, joined and not negate_next))
+            negate_next = False
+
+        groups, excluded = [], []
+        for (text, negated, joined), terms in zip(items, self.tokenize([text for text, _, _ in items])):
+            if not terms:
+                continue
+            if negated:
+                excluded.append(terms)
+            elif joined and groups:
+                groups[-1].append(terms)
+            else:
+                groups.append([terms])
+        if not groups:
+            raise ValueError(f"Nothing to search for in {query!r}, only stopwords or excluded terms")
+        return groups, excluded
+
+    def search(self,
+               query: str,
+               date_from=None,
+               date_to=None,
+               company: str = None,
+               limit: int = 20) -> pl.DataFrame:
+        """
+        Postings that match the query, best BM25 score first.
+
+        Args:
+            query (str): Words and "quoted phrases" that must all appear, e.g.
+                'dbt kafka', 'spark OR databricks', '"ingeniero de datos" -junior'.
+                Case and accents are ignored.
+            date_from: Only postings from this date on.
+            date_to: Only postings up to this date.
+            company (str): Only postings of companies whose name contains it, case insensitive.
+            limit (int): Maximum number of results.
+
+        Returns:
+            pl.DataFrame: job_url, title, company, date and score.
+        """
+        groups, excluded = self.parse_query(query)
+        items = [item for group in groups for item in group] + excluded
+        # Terms as IN lists of parameters, unlike list_contains they let DuckDB skip the row groups of other terms
+        terms = sorted({term for item in items for term, _ in item})
+        scored_terms = {term for group in groups for item in group for term, _ in item}
+        params = {f'term_{i}': term for i, term in enumerate(terms)}
+        terms_sql = ', '.join(f'$term_{i}' for i in range(len(terms)))
+        scored_terms_sql = ', '.join(f'$term_{i}' for i, term in enumerate(terms) if term in scored_terms)
+        params.update({'date_from': date_from, 'date_to': date_to, 'company': company, 'limit': limit,
+                       'k1': search_bm25_k1, 'b': search_bm25_b})
+
+        item_ctes = [f"item_{i} AS ({self._item_sql(item, f'item_{i}', params)})" for i, item in enumerate(items)]
+        item_names = {id(item): f"item_{i}" for i, item in enumerate(items)}
+        matched = ' INTERSECT '.join(
+            '(' + ' UNION '.join(f"SELECT doc_id FROM {item_names[id(item)]}" for item in group) + ')'
+            for group in groups)
+        if excluded:
+            matched = f"({matched}) EXCEPT (" + ' UNION '.join(f"SELECT doc_id FROM {item_names[id(item)]}" for item in excluded) + ')'
+
+        return self.conn.execute(f"""WITH query_postings AS MATERIALIZED (
+                                         SELECT term, doc_id, tf, positions FROM search_postings WHERE term IN ({terms_sql})),
+                                     {', '.join(item_ctes)},
+                                     stats AS (SELECT count(*) AS docs, avg(length) AS avg_length FROM search_docs),
+                                     -- BM25 per term (idf) and per posting (length normalization), computed once
+                                     idf AS (
+                                         SELECT p.term, ln(1 + (s.docs - count(*) + 0.5) / (count(*) + 0.5)) AS idf
+                                         FROM query_postings p CROSS JOIN stats s GROUP BY p.term, s.docs),
+                                     candidates AS (
+                                         SELECT d.doc_id, $k1 * (1 - $b + $b * d.length / s.avg_length) AS norm
+                                         FROM search_docs d CROSS JOIN stats s
+                                         WHERE d.doc_id IN ({matched})
+                                           AND ($date_from IS NULL OR d.date >= $date_from::DATE)
+                                           AND ($date_to IS NULL OR d.date <= $date_to::DATE)
+                                           AND ($company IS NULL OR d.company ILIKE '%' || $company || '%')),
+                                     scores AS (
+                                         SELECT c.doc_id, sum(f.idf * p.tf * ($k1 + 1) / (p.tf + c.norm)) AS score
+                                         FROM candidates c
+                                         JOIN query_postings p ON p.doc_id = c.doc_id AND p.term IN ({scored_terms_sql})
+                                         JOIN idf f ON f.term = p.term
+                                         GROUP BY c.doc_id
+                                         ORDER BY score DESC, c.doc_id
+                                         LIMIT $limit)
+                                     SELECT d.job_url, b.title, b.company, d.date, sc.score
+                                     FROM scores sc
+                                     JOIN search_docs d ON d.doc_id = sc.doc_id
+                                     LEFT JOIN base_table b ON b.job_url = d.job_url
+                                     ORDER BY sc.score DESC, sc.doc_id
+                                     """, params).pl()
+
+    @staticmethod
+    def _item_sql(item: list[tuple[str, int]], name: str, params: dict) -> str:
+        """Query of the doc_ids that contain a word, or a phrase with its terms at their offsets."""
+        (first_term, _), rest = item[0], item[1:]
+        params[f'{name}_0'] = first_term
+        if not rest:
+            return f"SELECT doc_id FROM query_postings WHERE term = ${name}_0"
+
+        joins, conditions = [], []
+        for i, (term, offset) in enumerate(rest, start=1):
+            params[f'{name}_{i}'] = term
+            joins.append(f"JOIN query_postings p{i} ON p{i}.doc_id = p0.doc_id AND p{i}.term = ${name}_{i}")
+            conditions.append(f"list_contains(p{i}.positions, x + {offset})")
+        return (f"SELECT p0.doc_id FROM query_postings p0 {' '.join(joins)} "
+                f"WHERE p0.term = ${name}_0 AND len(list_filter(p0.positions, x -> {' AND '.join(conditions)})) > 0")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Searches the job descriptions')
+    parser.add_argument('query', nargs='?', help='Words and "quoted phrases", OR between alternatives, -word to exclude')
+    parser.add_argument('--date-from', help='Only postings from this date on (YYYY-MM-DD)')
+    parser.add_argument('--date-to', help='Only postings up to this date (YYYY-MM-DD)')
+    parser.add_argument('--company', help='Only postings of companies whose name contains this')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--rebuild', action='store_true', help='Index all of base_table from scratch')
+    parser.add_argument('--optimize', action='store_true', help='Sort the postings by term, e.g. after many upserts')
+    args = parser.parse_args()
+
+    from db_functions import JobStore
+    store = JobStore(db_file)
+    try:
+        if args.rebuild or args.optimize:
+            store.conn.begin()
+            if args.rebuild:
+                store.search_index.rebuild()
+            else:
+                store.search_index.optimize()
+            store.conn.commit()
+        if args.query:
+            start = time.perf_counter()
+            results = store.search_index.search(args.query, args.date_from, args.date_to, args.company, args.limit)
+            with pl.Config(tbl_rows=args.limit, fmt_str_lengths=80):
+                print(results)
+            print(f"{len(results)} results in {(time.perf_counter() - start) * 1000:.1f} ms")
+    finally:
+        store.close()
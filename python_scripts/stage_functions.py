@@ -0,0 +1,251 @@
+"""
+Pipeline stages run as separate Airflow tasks (see dags/first_dag.py).
+
+discover writes the new job cards as Parquet shards, enrich_shard and classify_shard
+process one shard each (mapped tasks, so a failed shard is retried on its own) and
+load_shards is the only task that writes to DuckDB. The tasks only pass the paths of
+the Parquet files to each other. Each task also saves its metrics in the run directory,
+load_shards adds them up into the run metrics.
+"""
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+
+import duckdb
+import polars as pl
+
+from config import (archive_enabled, db_file, dataset_dir, fetch_burst, fetch_requests_per_second,
+                    gemini_pool_slots, keywords, linkedin_pool_slots, llm_requests_per_minute,
+                    llm_tokens_per_minute, model_version, pipeline_batch_size, search_queries,
+                    stage_dir, stage_shard_size)
+
+logger = logging.getLogger(__name__)
+
+# Job descriptions that mean the job page could not be read
+MISSING_DESCRIPTIONS = ('', 'Could not find Job Description')
+
+
+def run_dir(run_id: str) -> str:
+    """Directory of the Parquet files of a DAG run, Airflow run ids have characters that don't belong in paths."""
+    return os.path.join(stage_dir, re.sub(r'[^\w.-]', '_', run_id))
+
+
+def shard_path(path: str, stage: str) -> str:
+    """Path of the output of stage for the shard at path, e.g. .../jobcards/shard_00003.parquet -> .../enriched/shard_00003.parquet"""
+    directory = os.path.join(os.path.dirname(os.path.dirname(path)), stage)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, os.path.basename(path))
+
+
+# Up to linkedin_pool_slots enrich tasks and gemini_pool_slots classify tasks run at the same time, each
+# one with its own token buckets, so each gets its share of the rate limits to stay under them together
+
+def use_linkedin_pool_share():
+    from archive_functions import HtmlArchive
+    from fetch_functions import Fetcher, set_fetcher
+
+    set_fetcher(Fetcher(requests_per_second=fetch_requests_per_second / linkedin_pool_slots,
+                        burst=max(1, fetch_burst // linkedin_pool_slots),
+                        archive=HtmlArchive() if archive_enabled else None))
+
+
+def use_gemini_pool_share():
+    from genai_functions import LLMExecutor, set_executor
+
+    set_executor(LLMExecutor(requests_per_minute=llm_requests_per_minute / gemini_pool_slots,
+                             tokens_per_minute=llm_tokens_per_minute // gemini_pool_slots))
+
+
+def save_task_metrics(directory: str, name: str):
+    """Saves the metrics of this task as <directory>/metrics/<name>.json, for load_shards."""
+    from metrics_functions import metrics
+
+    os.makedirs(os.path.join(directory, 'metrics'), exist_ok=True)
+    with open(os.path.join(directory, 'metrics', f'{name}.json'), 'w') as f:
+        json.dump(metrics.summary(), f)
+
+
+def discover(run_id: str, shard_size: int = stage_shard_size) -> list[str]:
+    """
+    Runs every search and writes the new job cards that match the keywords in shards.
+
+    Returns:
+        list[str]: Paths of the job card shards, empty if there are no new jobs.
+    """
+    from db_functions import get_known_job_urls
+    from main import iter_jobcards_multi
+    from metrics_functions import metrics
+
+    metrics.reset()
+    known_urls, _ = get_known_job_urls(db_file)
+    jobcards = [{k: v for k, v in job.items() if k not in ('search_query', 'page_start')}
+                for job in iter_jobcards_multi(search_queries, known_urls)
+                if any(keyword in job['title'].lower() for keyword in keywords)]
+    save_task_metrics(run_dir(run_id), 'discover')
+    if not jobcards:
+        logger.info('No new job cards')
+        return []
+
+    directory = os.path.join(run_dir(run_id), 'jobcards')
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for number, df in enumerate(pl.DataFrame(jobcards).iter_slices(shard_size)):
+        path = os.path.join(directory, f'shard_{number:05d}.parquet')
+        df.write_parquet(path)
+        paths.append(path)
+    logger.info(f'Wrote {len(jobcards)} job cards in {len(paths)} shards to {directory}')
+    return paths
+
+
+def enrich_shard(path: str) -> str:
+    """
+    Fetches the job page of every job card in the shard.
+
+    Returns:
+        str: Path of the shard with the jobs that have a description.
+
+    Raises:
+        RuntimeError: If no job page of the shard could be read, so Airflow retries it.
+    """
+    from main import iter_enriched_jobs
+    from metrics_functions import metrics
+
+    metrics.reset()
+    use_linkedin_pool_share()
+    jobcards = pl.read_parquet(path).to_dicts()
+    df = pl.DataFrame(list(iter_enriched_jobs(jobcards, keywords)), infer_schema_length=None)
+    df = (df.filter(~pl.col('job_description').is_in(MISSING_DESCRIPTIONS))
+            .with_columns(pl.col('date').replace('', None)))
+    if jobcards and df.is_empty():
+        raise RuntimeError(f'Could not read any job page of {path}')
+
+    output_path = shard_path(path, 'enriched')
+    df.write_parquet(output_path)
+    save_task_metrics(os.path.dirname(os.path.dirname(path)), 'enrich_' + os.path.basename(path).removesuffix('.parquet'))
+    logger.info(f'Enriched {len(df)}/{len(jobcards)} jobs of {path}')
+    return output_path
+
+
+def classify_shard(path: str) -> str:
+    """
+    Classifies the jobs of an enriched shard. Descriptions already in the classification
+    cache are read from the DB without writing to it, load_shards adds the new ones.
+    Reposts of a stored posting aren't sent to the LLM, load_shards gives them the
+    classification of their canonical posting.
+
+    Returns:
+        str: Path of the shard with job_url, the classification columns and 'cached'.
+    """
+    from cache_functions import lookup_cached
+    from dedup_functions import NearDuplicateIndex
+    from genai_functions import classification_version
+    from main import classify_jobs
+    from metrics_functions import metrics
+    from schema_functions import GENAI_SCHEMA_OVERRIDES
+
+    metrics.reset()
+    use_gemini_pool_share()
+    df = pl.read_parquet(path).select('job_url', 'job_description')
+    cached = [None] * len(df)
+    duplicates = {}
+    if os.path.exists(db_file):
+        conn = duckdb.connect(database=db_file, read_only=True)
+        try:
+            cached = lookup_cached(conn, df['job_description'].to_list(), classification_version(), model_version)
+            with metrics.timer('dedup'):
+                duplicates = NearDuplicateIndex(conn, read_only=True).find_duplicates(df)
+        finally:
+            conn.close()
+
+    df_cached = pl.DataFrame([dict(c, job_url=job_url, cached=True)
+                              for job_url, c in zip(df['job_url'].to_list(), cached) if c is not None],
+                             schema_overrides=GENAI_SCHEMA_OVERRIDES)
+    skipped_urls = list(duplicates) + (df_cached['job_url'].to_list() if len(df_cached) else [])
+    df_new = classify_jobs(df.filter(~pl.col('job_url').is_in(skipped_urls)))
+    df_genai = pl.concat([df_cached, df_new.with_columns(cached=pl.lit(False))], how='diagonal_relaxed')
+
+    output_path = shard_path(path, 'classified')
+    df_genai.write_parquet(output_path)
+    save_task_metrics(os.path.dirname(os.path.dirname(path)), 'classify_' + os.path.basename(path).removesuffix('.parquet'))
+    logger.info(f'Classified {len(df_genai)}/{len(df)} jobs of {path}, {len(df_cached)} from the cache, '
+                f'{len(duplicates)} reposts left to load_shards')
+    return output_path
+
+
+def written_shards(paths: list[str | None]) -> list[str]:
+    """Paths of the shards that were written, a mapped task that failed after its retries has none."""
+    shards = sorted(path for path in paths if path and os.path.exists(path))
+    if len(shards) < len(paths):
+        logger.warning(f'{len(paths) - len(shards)} shards missing, their jobs are left to the next run')
+    return shards
+
+
+def load_shards(enriched_paths: list[str], classified_paths: list[str], run_id: str, keep_files: bool = False) -> int:
+    """
+    Writes the shards of a run to the Parquet dataset and DuckDB: base table, near
+    duplicates, GenAI table and classification cache. Then classifies the jobs left without
+    a classification (failed in classify_shard or in previous runs), saves the run metrics
+    of all the tasks and removes the run directory. Shards of mapped tasks that failed are
+    skipped: their job cards aren't stored, so the next discover finds them again.
+
+    Returns:
+        int: Number of jobs inserted into the base table.
+    """
+    from cache_functions import ClassificationCache
+    from dataset_functions import append_to_dataset
+    from db_functions import JobStore
+    from dedup_functions import NearDuplicateIndex
+    from genai_functions import classification_version
+    from main import classify_and_store
+    from metrics_functions import metrics, write_run_metrics
+
+    metrics.reset()
+    store = JobStore(db_file)
+    cache = ClassificationCache(db_file, classification_version(), model_version, conn=store.conn)
+    dedup_index = NearDuplicateIndex(store.conn)
+    jobs_loaded = 0
+    try:
+        descriptions = {}
+        for path in written_shards(enriched_paths):
+            df = pl.read_parquet(path)
+            if df.is_empty():
+                continue
+            append_to_dataset(df, dataset_dir)
+            jobs_loaded += store.upsert(df, 'base_table', 'base_data')
+            dedup_index.assign(df)
+            descriptions.update(zip(df['job_url'].to_list(), df['job_description'].to_list()))
+
+        for path in written_shards(classified_paths):
+            df_genai = pl.read_parquet(path)
+            if df_genai.is_empty():
+                continue
+            store.upsert(df_genai.drop('cached'), 'genai_table', 'genai_data')
+            for row in df_genai.filter(~pl.col('cached')).drop('cached').rows(named=True):
+                job_url = row.pop('job_url')
+                cache.put(descriptions[job_url], row)
+
+        dedup_index.copy_classifications(store)
+
+        # Backlog, a job dropped by classify_shard is already in base_table so discover won't bring it back
+        df_to_classify = store.get_unclassified_jobs()
+        logger.info(f'{len(df_to_classify)} jobs left to classify')
+        for df_batch in df_to_classify.iter_slices(pipeline_batch_size):
+            classify_and_store(df_batch, cache, store)
+        dedup_index.copy_classifications(store)
+        logger.info(f'DB writes: {store.summary()}')
+
+        for metrics_path in glob.glob(os.path.join(run_dir(run_id), 'metrics', '*.json')):
+            with open(metrics_path) as f:
+                metrics.merge(json.load(f))
+        write_run_metrics(store.conn, os.path.basename(run_dir(run_id)))
+    finally:
+        cache.close()
+        store.close()
+
+    if not keep_files:
+        shutil.rmtree(run_dir(run_id), ignore_errors=True)
+    return jobs_loaded
+
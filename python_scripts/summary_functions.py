@@ -0,0 +1,205 @@
+import argparse
+import logging
+
+import polars as pl
+
+from config import db_file
+
+logger = logging.getLogger(__name__)
+
+# One row per classified job with the dimensions the summaries group by
+JOB_FACTS_SQL = """CREATE OR REPLACE VIEW job_facts AS
+                   SELECT b.job_url,
+                          date_trunc('week', b.date)::DATE AS week,
+                          coalesce(b.company, '') AS company,
+                          coalesce(g.seniority_level_ai, 'Unknown') AS seniority_level_ai,
+                          coalesce(g.cloud_preference, 'Unknown') AS cloud_preference,
+                          coalesce(g.years_of_experience, 'Unknown') AS years_of_experience,
+                          g.skills_mentioned
+                   FROM base_table b JOIN genai_readable g ON b.job_url = g.job_url;
+                   """
+
+# Summary table -> key columns and the query over job_facts that yields one row per counted item.
+# {changed} filters the jobs to count: TRUE for a rebuild, the job_urls of an upsert otherwise.
+SUMMARY_TABLES = {
+    'summary_weekly_skills': {
+        'keys': {'week': 'DATE', 'skill': 'VARCHAR'},
+        'query': "SELECT week, unnest(skills_mentioned) AS skill FROM job_facts WHERE week IS NOT NULL AND {changed}",
+    },
+    'summary_weekly_seniority': {
+        'keys': {'week': 'DATE', 'seniority_level_ai': 'VARCHAR'},
+        'query': "SELECT week, seniority_level_ai FROM job_facts WHERE week IS NOT NULL AND {changed}",
+    },
+    'summary_weekly_cloud': {
+        'keys': {'week': 'DATE', 'cloud_preference': 'VARCHAR'},
+        'query': "SELECT week, cloud_preference FROM job_facts WHERE week IS NOT NULL AND {changed}",
+    },
+    'summary_company_seniority': {
+        'keys': {'company': 'VARCHAR', 'seniority_level_ai': 'VARCHAR'},
+        'query': "SELECT company, seniority_level_ai FROM job_facts WHERE {changed}",
+    },
+    'summary_years_experience': {
+        'keys': {'years_of_experience': 'VARCHAR'},
+        'query': "SELECT years_of_experience FROM job_facts WHERE {changed}",
+    },
+}
+
+
+class SummaryTables:
+    """
+    Pre-aggregated counts over base_table joined with genai_table (weekly skills, seniority
+    and cloud, company x seniority, years of experience), so the usual questions don't
+    scan and unnest all history.
+
+    JobStore keeps them up to date inside each upsert transaction: the contribution of the
+    upserted job_urls is subtracted before the upsert and added back after it, so inserts,
+    updates and reclassifications only touch the groups of the changed rows.
+
+    Args:
+        conn (duckdb.DuckDBPyConnection): Connection to the project database, base_table
+            and genai_table must exist.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.execute(JOB_FACTS_SQL)
+        existing = {row[0] for row in self.conn.execute("SELECT table_name FROM duckdb_tables()").fetchall()}
+        for table_name, summary in SUMMARY_TABLES.items():
+            columns = ', '.join(f'{key} {type_}' for key, type_ in summary['keys'].items())
+            self.conn.execute(f"""CREATE TABLE IF NOT EXISTS {table_name}(
+                                  {columns},
+                                  jobs BIGINT,
+                                  PRIMARY KEY ({', '.join(summary['keys'])})
+                                  );
+                                  """)
+        # Summaries added to a database that already has data start from a full build
+        if not existing.issuperset(SUMMARY_TABLES):
+            self.rebuild()
+
+    def apply(self, changed_relation: str, sign: int):
+        """
+        Adds (sign=1) or subtracts (sign=-1) the current contribution of the jobs whose
+        job_url is in changed_relation. Runs in the caller's transaction.
+        """
+        changed = f"job_url IN (SELECT job_url FROM {changed_relation})"
+        for table_name, summary in SUMMARY_TABLES.items():
+            keys = ', '.join(summary['keys'])
+            self.conn.execute(f"""INSERT INTO {table_name}
+                                  SELECT {keys}, {sign} * count(*) FROM ({summary['query'].format(changed=changed)})
+                                  GROUP BY {keys}
+                                  ON CONFLICT DO UPDATE SET jobs = jobs + excluded.jobs;
+                                  """)
+            if sign > 0:
+                self.conn.execute(f"DELETE FROM {table_name} WHERE jobs = 0")
+
+    def rebuild(self):
+        """Recomputes every summary from all history."""
+        for table_name, summary in SUMMARY_TABLES.items():
+            keys = ', '.join(summary['keys'])
+            self.conn.execute(f"DELETE FROM {table_name}")
+            self.conn.execute(f"""INSERT INTO {table_name}
+                                  SELECT {keys}, count(*) FROM ({summary['query'].format(changed='TRUE')})
+                                  GROUP BY {keys};
+                                  """)
+        logger.info(f"Rebuilt {len(SUMMARY_TABLES)} summary tables")
+
+    def check(self) -> dict:
+        """
+        Compares every summary with a recomputation from all history.
+
+        Returns:
+            dict: Number of groups that differ per summary table, 0 when consistent.
+        """
+        differences = {}
+        for table_name, summary in SUMMARY_TABLES.items():
+            keys = ', '.join(summary['keys'])
+            expected = f"SELECT {keys}, count(*) AS jobs FROM ({summary['query'].format(changed='TRUE')}) GROUP BY {keys}"
+            differences[table_name] = self.conn.execute(f"""SELECT count(*) FROM (
+                                                            (SELECT * FROM {table_name} EXCEPT ALL {expected})
+                                                            UNION ALL
+                                                            ({expected} EXCEPT ALL SELECT * FROM {table_name}))
+                                                            """).fetchone()[0]
+        return differences
+
+    # Query API, every answer reads only the summary tables
+
+    def weekly_totals(self) -> pl.DataFrame:
+        """Classified jobs per posting week."""
+        return self.conn.execute("""SELECT week, sum(jobs)::BIGINT AS jobs FROM summary_weekly_seniority
+                                    GROUP BY week ORDER BY week""").pl()
+
+    def skill_demand(self, weeks: int = None, skill: str = None) -> pl.DataFrame:
+        """
+        Jobs mentioning each skill per week and their share of the week's jobs.
+
+        Args:
+            weeks (int): Only the last weeks, all of them by default.
+            skill (str): Only this skill, all of them by default.
+        """
+        return self.conn.execute("""WITH totals AS (SELECT week, sum(jobs) AS total FROM summary_weekly_seniority GROUP BY week)
+                                    SELECT s.week, s.skill, s.jobs, s.jobs / t.total AS share
+                                    FROM summary_weekly_skills s JOIN totals t ON s.week = t.week
+                                    WHERE ($1 IS NULL OR s.week > (SELECT max(week) FROM totals) - to_weeks($1::INTEGER))
+                                      AND ($2 IS NULL OR s.skill = $2)
+                                    ORDER BY s.week, s.jobs DESC, s.skill""", [weeks, skill]).pl()
+
+    def top_skills(self, weeks: int = None, top: int = 10) -> pl.DataFrame:
+        """Skills mentioned by the most jobs over the last weeks (all history by default)."""
+        return self.conn.execute("""SELECT skill, sum(jobs)::BIGINT AS jobs FROM summary_weekly_skills
+                                    WHERE $1 IS NULL OR week > (SELECT max(week) FROM summary_weekly_skills) - to_weeks($1::INTEGER)
+                                    GROUP BY skill ORDER BY jobs DESC, skill LIMIT $2""", [weeks, top]).pl()
+
+    def seniority_mix(self, by_week: bool = False) -> pl.DataFrame:
+        """Share of jobs per seniority level, overall or per week."""
+        if by_week:
+            return self.conn.execute("""SELECT week, seniority_level_ai, jobs,
+                                               jobs / sum(jobs) OVER (PARTITION BY week) AS share
+                                        FROM summary_weekly_seniority ORDER BY week, jobs DESC""").pl()
+        return self.conn.execute("""SELECT seniority_level_ai, sum(jobs)::BIGINT AS jobs,
+                                           sum(jobs) / sum(sum(jobs)) OVER () AS share
+                                    FROM summary_weekly_seniority GROUP BY seniority_level_ai ORDER BY jobs DESC""").pl()
+
+    def cloud_share(self, by_week: bool = False) -> pl.DataFrame:
+        """Share of jobs per cloud preference, overall or per week."""
+        if by_week:
+            return self.conn.execute("""SELECT week, cloud_preference, jobs,
+                                               jobs / sum(jobs) OVER (PARTITION BY week) AS share
+                                        FROM summary_weekly_cloud ORDER BY week, jobs DESC""").pl()
+        return self.conn.execute("""SELECT cloud_preference, sum(jobs)::BIGINT AS jobs,
+                                           sum(jobs) / sum(sum(jobs)) OVER () AS share
+                                    FROM summary_weekly_cloud GROUP BY cloud_preference ORDER BY jobs DESC""").pl()
+
+    def years_distribution(self) -> pl.DataFrame:
+        """Jobs per required years of experience."""
+        return self.conn.execute("""SELECT years_of_experience, jobs, jobs / sum(jobs) OVER () AS share
+                                    FROM summary_years_experience ORDER BY years_of_experience""").pl()
+
+    def company_seniority(self, top: int = 20) -> pl.DataFrame:
+        """Jobs per seniority level of the companies with the most jobs."""
+        return self.conn.execute("""WITH top_companies AS (
+                                        SELECT company FROM summary_company_seniority
+                                        GROUP BY company ORDER BY sum(jobs) DESC, company LIMIT $1)
+                                    SELECT s.company, s.seniority_level_ai, s.jobs FROM summary_company_seniority s
+                                    WHERE s.company IN (SELECT company FROM top_companies)
+                                    ORDER BY s.company, s.jobs DESC""", [top]).pl()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Checks the summary tables against a full recomputation')
+    parser.add_argument('--rebuild', action='store_true', help='Recompute every summary table from all history')
+    args = parser.parse_args()
+
+    from db_functions import JobStore
+    store = JobStore(db_file)
+    try:
+        if args.rebuild:
+            store.conn.begin()
+            store.summaries.rebuild()
+            store.conn.commit()
+        differences = store.summaries.check()
+    finally:
+        store.close()
+    print(differences)
+    if any(differences.values()):
+        raise SystemExit('Summary tables differ from a full recomputation, run with --rebuild')
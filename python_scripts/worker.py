@@ -0,0 +1,147 @@
+"""
+Long-running pipeline worker.
+
+Keeps the Gemini client, the HTTP connection pool and the known job URLs in memory between
+runs, so each hourly run doesn't pay for the imports, the client setup and loading the known
+URLs again. The DAG triggers the runs through a small HTTP API:
+
+    POST /run[?full_refresh=1]   runs the pipeline, answers with the run metrics as JSON
+    GET  /health                 warm-up time, runs served and number of known URLs
+
+DuckDB allows a single read-write process per file, so the worker opens the DB only for the
+duration of a run. Between runs the search, summary and rules CLIs can use the file; during a
+run they fail with a lock error and have to be retried. The known URLs aren't reloaded between
+runs, so jobs stored by another process (e.g. main.py) while the worker lives are fetched again
+and upserted.
+
+Usage:
+    python worker.py [--host 0.0.0.0] [--port 8793]
+"""
+import time
+# Start of the process, to report how long the warm-up took
+STARTED = time.perf_counter()
+
+import argparse
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from config import db_file, worker_port
+from db_functions import JobStore, get_known_job_urls
+from fetch_functions import get_fetcher
+from genai_functions import get_model
+from main import run_pipeline
+from metrics_functions import metrics, setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+class RunInProgressError(RuntimeError):
+    """Raised when a run is triggered while another one is still running."""
+
+
+class PipelineWorker:
+    """
+    Holds the state reused across runs and runs the pipeline one run at a time.
+
+    Args:
+        db_file (str): Path to the DuckDB file, opened only while a run is in progress.
+    """
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self.known_urls, _ = get_known_job_urls(db_file)
+        # Create the clients now instead of in the first run
+        get_model()
+        get_fetcher()
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.warmup_seconds = time.perf_counter() - STARTED
+        logger.info(f'Worker ready in {self.warmup_seconds:.2f} seconds with {len(self.known_urls)} known jobs')
+
+    def run(self, full_refresh: bool = False) -> dict:
+        """
+        Runs the pipeline once.
+
+        Returns:
+            dict: The run metrics, with the path of the metrics file in 'metrics_path'.
+
+        Raises:
+            RunInProgressError: If another run hasn't finished yet.
+        """
+        if not self.lock.acquire(blocking=False):
+            raise RunInProgressError('A run is already in progress')
+        try:
+            metrics.reset()
+            known_urls = set() if full_refresh else self.known_urls
+            # Open the DB only for the run, so other processes can use it between runs
+            store = JobStore(self.db_file)
+            try:
+                metrics_path = run_pipeline(store, known_urls, full_refresh)
+                if full_refresh:
+                    self.known_urls, _ = store.get_known_job_urls()
+            finally:
+                store.close()
+            self.runs += 1
+            with open(metrics_path) as f:
+                return dict(json.load(f), metrics_path=metrics_path)
+        finally:
+            self.lock.release()
+
+    def health(self) -> dict:
+        return {
+            'status': 'running' if self.lock.locked() else 'idle',
+            'warmup_seconds': round(self.warmup_seconds, 3),
+            'runs': self.runs,
+            'known_urls': len(self.known_urls),
+        }
+
+
+class WorkerHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, status: int, body: dict):
+        content = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self.send_json(200, self.server.worker.health())
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/run':
+            self.send_json(404, {'error': 'not found'})
+            return
+        full_refresh = parse_qs(url.query).get('full_refresh', ['0'])[0] in ('1', 'true')
+        try:
+            self.send_json(200, self.server.worker.run(full_refresh))
+        except RunInProgressError as e:
+            self.send_json(409, {'error': str(e)})
+        except Exception as e:
+            logger.exception('Run failed')
+            self.send_json(500, {'error': repr(e)})
+
+    def log_message(self, format, *args):
+        logger.info(format % args)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Long-running pipeline worker')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=worker_port)
+    args = parser.parse_args()
+
+    setup_logging()
+    server = ThreadingHTTPServer((args.host, args.port), WorkerHandler)
+    server.worker = PipelineWorker(db_file)
+    logger.info(f'Listening on {args.host}:{args.port}')
+    server.serve_forever()